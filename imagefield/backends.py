@@ -0,0 +1,171 @@
+import logging
+import operator
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+from functools import cache, reduce
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+@cache
+def _backend(path):
+    return import_string(path)()
+
+
+def generation_backend():
+    """
+    Return the backend configured using ``IMAGEFIELD_GENERATION_BACKEND``
+    """
+    return _backend(settings.IMAGEFIELD_GENERATION_BACKEND)
+
+
+class SynchronousBackend:
+    """
+    Generates processed images right away when saving models
+    """
+
+    def generate(self, field, instance):
+        getattr(instance, field.name).process_many(field.formats)
+
+
+class ThreadPoolBackend:
+    """
+    Generates processed images in a thread pool after the current transaction
+    has been committed
+    """
+
+    max_workers = 2
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="imagefield"
+        )
+        self.pending = set()
+
+    def generate(self, field, instance):
+        model, pk = type(instance), instance.pk
+        transaction.on_commit(lambda: self._submit(field, model, pk))
+
+    def _submit(self, field, model, pk):
+        # Load the instance again instead of sharing the caller's field file
+        # with the worker thread
+        if (instance := model._base_manager.filter(pk=pk).first()) is None:
+            return
+        future = self.executor.submit(
+            getattr(instance, field.name).process_many, list(field.formats)
+        )
+        self.pending.add(future)
+        future.add_done_callback(
+            lambda future: self._done(future, field.field_label, pk)
+        )
+
+    def _done(self, future, field_label, pk):
+        self.pending.discard(future)
+        if (exc := future.exception()) is not None:
+            logger.error(
+                'Unable to process "%(field)s #%(pk)s"',
+                {"field": field_label, "pk": pk},
+                exc_info=exc,
+            )
+
+    def wait(self):
+        """
+        Wait until all submitted images have been generated
+        """
+        wait(list(self.pending))
+
+
+class QueueBackend:
+    """
+    Adds generation tasks to a database table which is drained by running
+    ``./manage.py process_imagefield_queue``
+    """
+
+    #: Seconds after which tasks claimed by a worker which didn't finish them
+    #: are processed again
+    claim_timeout = 600
+    #: Count of failed attempts after which tasks are kept in the table but
+    #: not processed anymore
+    max_attempts = 5
+
+    def generate(self, field, instance):
+        from imagefield.models import GenerationTask
+
+        # Queueing a task again while it is being processed resets it so that
+        # the worker processing it doesn't delete it afterwards
+        GenerationTask.objects.update_or_create(
+            field_label=field.field_label,
+            object_pk=str(instance.pk),
+            defaults={"created_at": timezone.now(), "claimed_at": None, "attempts": 0},
+        )
+
+    def drain(self, *, batch_size=100):
+        """
+        Process up to ``batch_size`` tasks and return the count of tasks
+        processed
+
+        Tasks are claimed in a short transaction and processed outside of it.
+        Failed tasks are released again and retried up to ``max_attempts``
+        times.
+        """
+        from imagefield.fields import _imagefields_by_label
+        from imagefield.models import GenerationTask
+
+        fields = _imagefields_by_label()
+
+        now = timezone.now()
+        claimable = Q(claimed_at__isnull=True) | Q(
+            claimed_at__lt=now - timedelta(seconds=self.claim_timeout)
+        )
+        with transaction.atomic():
+            queryset = GenerationTask.objects.filter(
+                claimable, attempts__lt=self.max_attempts
+            ).order_by("pk")
+            if connection.features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            pks = list(queryset.values_list("pk", flat=True)[:batch_size])
+            # Without row locks other workers may have claimed some of the
+            # tasks in the meantime, only process those claimed here
+            GenerationTask.objects.filter(claimable, pk__in=pks).update(claimed_at=now)
+            tasks = list(GenerationTask.objects.filter(pk__in=pks, claimed_at=now))
+
+        done, failed = [], []
+        for task in tasks:
+            if (field := fields.get(task.field_label)) is None:
+                done.append(task)
+                continue
+            instance = field.model._base_manager.filter(pk=task.object_pk).first()
+            if instance is None:
+                done.append(task)
+                continue
+            try:
+                getattr(instance, field.name).process_many(field.formats)
+            except Exception:
+                logger.exception('Unable to process "%(task)s"', {"task": task})
+                failed.append(task)
+            else:
+                done.append(task)
+
+        # Tasks queued again in the meantime have been reset and are kept
+        if done:
+            GenerationTask.objects.filter(_unchanged(done)).delete()
+        if failed:
+            GenerationTask.objects.filter(_unchanged(failed)).update(
+                claimed_at=None, attempts=F("attempts") + 1
+            )
+
+        return len(tasks)
+
+
+def _unchanged(tasks):
+    return reduce(
+        operator.or_,
+        (Q(pk=task.pk, created_at=task.created_at) for task in tasks),
+    )
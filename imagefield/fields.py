@@ -1,15 +1,22 @@
+import asyncio
+import contextvars
 import hashlib
 import io
 import logging
 import os
+import threading
+import time
+import types
 import warnings
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from random import randint
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core import checks
 from django.core.cache import cache
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.files.base import ContentFile
 from django.db import models
 from django.db.models import signals
@@ -17,9 +24,21 @@ from django.db.models.fields import files
 from django.forms import ClearableFileInput
 from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
-from PIL import Image, ImageFile
-
-from imagefield.processing import build_handler
+from PIL import Image, ImageFile, JpegImagePlugin
+
+from imagefield.backends import generation_backend
+from imagefield.processing import (
+    LADDER_REDUCING_GAP,
+    LOSSY_FORMATS,
+    build_handler,
+    compiled,
+    draft,
+    encoder_options,
+    is_passthrough,
+    spec_key,
+    strip_metadata,
+)
+from imagefield.rendering import image_cost, render_executor
 from imagefield.websafe import websafe
 from imagefield.widgets import (
     PPOIWidget,
@@ -34,9 +53,17 @@ DEFAULTS = {
     "IMAGEFIELD_CACHE_TIMEOUT": lambda: randint(170 * 86400, 190 * 86400),
     "IMAGEFIELD_FORMATS": {},
     "IMAGEFIELD_VALIDATE_ON_SAVE": True,
+    "IMAGEFIELD_VALIDATION": "decode",
     "IMAGEFIELD_SILENTFAILURE": False,
     "IMAGEFIELD_VERSATILEIMAGEPROXY": False,
     "IMAGEFIELD_BIN_DEPTH": 1,
+    "IMAGEFIELD_GENERATION_BACKEND": "imagefield.backends.SynchronousBackend",
+    "IMAGEFIELD_EXISTS_CACHE": True,
+    "IMAGEFIELD_EXISTS_LRU_TIMEOUT": 5,
+    "IMAGEFIELD_MANIFEST": False,
+    "IMAGEFIELD_RENDER_WORKERS": 1,
+    "IMAGEFIELD_RENDER_MEMORY": 256 * 1024 * 1024,
+    "IMAGEFIELD_PASSTHROUGH": True,
 }
 for setting, default in DEFAULTS.items():
     if not hasattr(settings, setting):
@@ -85,14 +112,226 @@ class Context:
 
 
 logger = logging.getLogger(__name__)
+#: The lowest quality used for reaching a ``target_bytes`` size by default
+MIN_QUALITY = 30
+#: Upper bound of the encoded size of a sample of progressive JPEGs, used
+#: for sizing the encoding buffer
+JPEG_BYTES_PER_SAMPLE = 2
 #: Imagefield instances
 IMAGEFIELDS = []
 
 
+def _imagefields_by_label():
+    fields = {}
+    for field in IMAGEFIELDS:
+        # Fields of models rendered from migration states are added later and
+        # use the same labels
+        fields.setdefault(field.field_label, field)
+    return fields
+
+
 def hashdigest(str):
     return hashlib.sha1(str.encode("utf-8")).hexdigest()
 
 
+class _LRUCache:
+    """
+    Thread-safe mapping which forgets the least recently used entries
+
+    ``timeout`` is a callable returning the seconds after which entries
+    expire, entries do not expire if it is ``None``.
+    """
+
+    def __init__(self, maxsize, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, expires = self._data[key]
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None if self.timeout is None else time.monotonic() + self.timeout()
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+#: Processed names known to exist, checked before asking the Django cache
+#: and finally the storage itself. Entries expire after a few seconds so that
+#: processed images deleted by other processes are noticed; the deleting
+#: process removes them from the Django cache.
+_exists_lru = _LRUCache(10000, timeout=lambda: settings.IMAGEFIELD_EXISTS_LRU_TIMEOUT)
+#: Processed names etc. derived from the source name, PPOI and spec
+_context_lru = _LRUCache(10000)
+
+
+def _remember_exists(name):
+    _exists_lru.set(name, 1)
+    if (batch := _batch.get()) is not None:
+        batch.remembered.add(name)
+    else:
+        cache.set(cache_key(name), 1, timeout=cache_timeout())
+
+
+async def _aremember_exists(name):
+    _exists_lru.set(name, 1)
+    await cache.aset(cache_key(name), 1, timeout=cache_timeout())
+
+
+def _forget_exists(names):
+    for name in names:
+        _exists_lru.pop(name)
+    cache.delete_many([cache_key(name) for name in names])
+
+
+def _exists(storage, name):
+    if settings.IMAGEFIELD_EXISTS_CACHE:
+        if _exists_lru.get(name):
+            return True
+        batch = _batch.get()
+        if (batch is None or name not in batch.looked_up) and cache.get(
+            cache_key(name)
+        ):
+            _remember_exists(name)
+            return True
+    if storage.exists(name):
+        if settings.IMAGEFIELD_EXISTS_CACHE:
+            _remember_exists(name)
+        return True
+    return False
+
+
+async def _aexists(storage, name):
+    if settings.IMAGEFIELD_EXISTS_CACHE:
+        if _exists_lru.get(name):
+            return True
+        if await cache.aget(cache_key(name)):
+            await _aremember_exists(name)
+            return True
+    if await sync_to_async(storage.exists, thread_sensitive=False)(name):
+        if settings.IMAGEFIELD_EXISTS_CACHE:
+            await _aremember_exists(name)
+        return True
+    return False
+
+
+class _Batch:
+    def __init__(self):
+        self.requests = []
+        self.looked_up = set()
+        self.remembered = set()
+
+    def process(self):
+        contexts = [
+            (fieldfile, processors, silent, fieldfile._process_context(processors))
+            for fieldfile, processors, silent in self.requests
+        ]
+        # The cache is queried even if IMAGEFIELD_EXISTS_CACHE is disabled,
+        # the versatile image proxy and the widget always used it
+        names = {
+            context.name
+            for *_rest, context in contexts
+            if context.name
+            and not (settings.IMAGEFIELD_EXISTS_CACHE and _exists_lru.get(context.name))
+        }
+        keys = {cache_key(name): name for name in names}
+        found = {keys[key] for key in cache.get_many(keys)}
+        if settings.IMAGEFIELD_EXISTS_CACHE:
+            for name in found:
+                _exists_lru.set(name, 1)
+            self.looked_up = names
+
+        by_file = {}
+        for fieldfile, processors, silent, context in contexts:
+            if context.name not in found:
+                by_file.setdefault(id(fieldfile), (fieldfile, []))[1].append(
+                    (processors, silent, context.name)
+                )
+        for fieldfile, specs in by_file.values():
+            try:
+                processed = fieldfile.process_many([spec[0] for spec in specs])
+            except Exception:
+                if not all(silent for _p, silent, _n in specs):
+                    raise
+                continue
+            if not settings.IMAGEFIELD_EXISTS_CACHE:
+                self.remembered.update(
+                    name
+                    for (_p, _s, name), result in zip(specs, processed)
+                    if name and name == result
+                )
+
+        if self.remembered:
+            cache.set_many(
+                {cache_key(name): 1 for name in self.remembered},
+                timeout=cache_timeout(),
+            )
+
+
+_batch = contextvars.ContextVar("imagefield_batch", default=None)
+
+
+@contextmanager
+def batched_processing():
+    """
+    Defer processing images requested by the versatile image proxy and by
+    form widgets until the end of the block
+
+    The existence of all requested images is looked up in the cache using
+    one query, and newly processed images are added to the cache using one
+    query as well. Blocks may be nested; only the outermost block processes
+    images.
+    """
+    if _batch.get() is not None:
+        yield
+        return
+
+    batch = _Batch()
+    token = _batch.set(batch)
+    try:
+        yield
+        batch.process()
+    finally:
+        _batch.reset(token)
+
+
+def _context_key(processors, name, ppoi, digest=""):
+    """
+    Return a key for memoizing the outcome of ``_process_context`` or ``None``
+    if the processors spec does not allow this
+
+    Callable specs have to opt in by setting ``cacheable = True``, which they
+    may only do if they depend on nothing but the extension of the source.
+    """
+    if callable(processors):
+        if not getattr(processors, "cacheable", False):
+            return None
+        spec = processors
+    elif (spec := spec_key(processors)) is None:
+        return None
+    return (spec, name, tuple(ppoi), digest, settings.IMAGEFIELD_BIN_DEPTH)
+
+
 class VersatileImageProxy:
     def __init__(self, file, item):
         self.file = file
@@ -112,25 +351,83 @@ class VersatileImageProxy:
         self.items.append(attribute)
         return self
 
-    def __str__(self):
+    def _processors(self):
         processors = [
             "default",
             (self.items[0], tuple(map(int, self.items[1].split("x")))),
         ]
         if settings.IMAGEFIELD_VERSATILEIMAGEPROXY == "websafe":
             processors = websafe(processors)
+        return processors
+
+    def __str__(self):
+        processors = self._processors()
         context = self.file._process_context(processors)
-        key = cache_key(context.name)
-        url = self.file.storage.url(context.name)
-        if not cache.get(key):
-            self.file.process(processors)
-            cache.set(key, 1, timeout=cache_timeout())
-        return url
+        self.file._process_or_defer(processors)
+        return self.file.storage.url(context.name)
+
+    async def aurl(self):
+        return await self.file.aurl(self._processors())
 
 
 _ProcessBase = namedtuple("_ProcessBase", "path basename")
 
 
+class _SharedPrefix:
+    """
+    Runs the processors shared by several specs once and remembers the
+    resulting image and the save keyword arguments they produced
+    """
+
+    def __init__(self, image, context, processors):
+        save_kwargs = dict(context.save_kwargs)
+        prefix = Context(**dict(context.__dict__, save_kwargs=save_kwargs))
+        prefix.seal()
+        self.image = build_handler(processors)(image, prefix)
+        self.save_kwargs = save_kwargs
+        self.rungs = []
+
+    def rung_source(self, width):
+        """
+        Return the smallest image of the ladder rungs rendered so far which
+        may be downscaled to ``width`` without losing quality
+        """
+        return min(
+            (
+                image
+                for image in self.rungs
+                if image.width >= width * LADDER_REDUCING_GAP
+            ),
+            key=lambda image: image.width,
+            default=self.image,
+        )
+
+
+def _split_shared(processors):
+    """
+    Split processors into the processors whose result may be shared between
+    specs and the processors running on the shared result
+    """
+    if not processors:
+        return None, processors
+    if processors[0] == "default":
+        return ["default"], processors[1:]
+    if isinstance(processors[0], list | tuple) and processors[0][0] in {
+        "transcode",
+        "ladder",
+    }:
+        # Transcoding and ladder rungs only change the fully processed image
+        return processors[1:], processors[:1]
+    return None, processors
+
+
+def _ladder_width(processors):
+    if processors and isinstance(processors[0], list | tuple):
+        if processors[0][0] == "ladder":
+            return processors[0][1]
+    return 0
+
+
 class ImageFieldFile(files.ImageFieldFile):
     def __getattr__(self, item):
         # The "field" attribute is not there after unpickling. We cannot
@@ -143,10 +440,53 @@ class ImageFieldFile(files.ImageFieldFile):
             url = self.storage.url(context.name) if context.name else ""
             setattr(self, item, url)
             return url
+        elif item.endswith("_srcset") and (rungs := self._ladder_rungs(item[:-7])):
+            srcset = ", ".join(
+                f"{getattr(self, rung)} {width}w"
+                for width, rung in self._rendered_widths(rungs)
+            )
+            setattr(self, item, srcset)
+            return srcset
         elif settings.IMAGEFIELD_VERSATILEIMAGEPROXY and item in {"thumbnail", "crop"}:
             return VersatileImageProxy(self, item)
         raise AttributeError(f"Attribute '{item}' on '{self.field}' unknown")
 
+    def _ladder_rungs(self, item):
+        """
+        Return ``(width, format)`` tuples of the ladder rungs of ``item``
+        """
+        return sorted(
+            (width, key)
+            for key, spec in self.field.formats.items()
+            if key.startswith(f"{item}_")
+            and isinstance(spec, list | tuple)
+            and spec
+            and (width := _ladder_width(spec))
+            and key == f"{item}_{width}"
+        )
+
+    def _rendered_widths(self, rungs):
+        """
+        Return ``(width, format)`` tuples of ladder rungs with the width they
+        are rendered at
+
+        Images are never upscaled, rungs wider than the source are rendered
+        at the width of the source. Only the narrowest of those is returned.
+        """
+        try:
+            source_width = (
+                self.field.width_field
+                and getattr(self.instance, self.field.width_field)
+                or self.width
+            )
+        except (OSError, ValueError):
+            # Missing or unreadable source, use the declared widths
+            return rungs
+        widths = {}
+        for width, rung in rungs:
+            widths.setdefault(min(width, source_width), rung)
+        return list(widths.items())
+
     def _ppoi(self):
         if self.field.ppoi_field:
             try:
@@ -160,9 +500,21 @@ class ImageFieldFile(files.ImageFieldFile):
                 pass
         return [0.5, 0.5]
 
-    def _process_base(self, name):
-        p1 = hashdigest(name)
-        filename, _ = os.path.splitext(os.path.basename(name))
+    def _digest(self):
+        # Names changed without going through save() do not match the check
+        # anymore and fall back to name-based processed images
+        if self.field.digest_field and self.name:
+            value = getattr(self.instance, self.field.digest_field) or ""
+            digest, _sep, check = value.partition(":")
+            if check == hashdigest(self.name)[:8]:
+                return digest
+        return ""
+
+    def _process_base(self, name, digest=""):
+        # Sources with a content digest share processed images with all other
+        # sources having the same contents
+        p1 = digest or hashdigest(name)
+        filename = digest or os.path.splitext(os.path.basename(name))[0]
         bins = "/".join(
             p1[i : i + 3] for i in range(0, settings.IMAGEFIELD_BIN_DEPTH * 3, 3)
         )
@@ -170,66 +522,215 @@ class ImageFieldFile(files.ImageFieldFile):
 
     def _process_context(self, processors):
         name = self.name or self.field._fallback
+        ppoi = self._ppoi()
+        digest = self._digest()
+        key = _context_key(processors, name, ppoi, digest)
+        if key is not None and (memo := _context_lru.get(key)):
+            extension, processors, processed_name, spec_hash = memo
+            context = Context(
+                ppoi=ppoi,
+                save_kwargs={},
+                extension=extension,
+                processors=processors,
+                name=processed_name,
+                source=name,
+                spec_hash=spec_hash,
+            )
+            context.seal()
+            return context
+
         context = Context(
-            ppoi=self._ppoi(),
+            ppoi=ppoi,
             save_kwargs={},
             extension=os.path.splitext(name)[1],
             processors=processors,
             name=name,
             source=name,
+            spec_hash="",
         )
         while callable(context.processors):
             context.processors(self, context)
         if context.name:
-            base = self._process_base(context.name)
-            spec = (
-                "|".join(str(p) for p in context.processors) + "|" + str(context.ppoi)
-            )
-            p2 = hashdigest(spec)
-            context.name = f"{base.path}/{base.basename}{p2[:12]}{context.extension}"
+            base = self._process_base(context.name, digest)
+            spec = compiled(context.processors).spec + "|" + str(context.ppoi)
+            context.spec_hash = hashdigest(spec)
+            context.name = f"{base.path}/{base.basename}{context.spec_hash[:12]}{context.extension}"
         context.seal()
+        if key is not None:
+            _context_lru.set(
+                key,
+                (
+                    context.extension,
+                    context.processors,
+                    context.name,
+                    context.spec_hash,
+                ),
+            )
         return context
 
-    def process(self, spec, *, force=False):
+    def _spec_processors(self, spec):
         if isinstance(spec, list | tuple):
-            processors = spec
-            spec = "<ad hoc>"
+            return spec, "<ad hoc>"
         elif callable(spec):
-            processors = spec  # Evaluated in _process_context
-            spec = "<callable>"
-        else:
-            processors = self.field.formats[spec]
+            return spec, "<callable>"  # Evaluated in _process_context
+        return self.field.formats[spec], spec
+
+    def process(self, spec, *, force=False):
+        return self.process_many([spec], force=force)[0]
+
+    def process_many(self, specs, *, force=False, executor=None):
+        """
+        Process several specs at once, reading and decoding the source only once
+
+        Returns a list of processed names in the same order as ``specs``.
+        The specs are rendered using ``executor``, which defaults to the
+        executor configured using ``IMAGEFIELD_RENDER_WORKERS``.
+        """
+        names, contexts = self._contexts(specs)
+        pending = []
+        for index, context in contexts:
+            already_exists = (
+                self.storage.exists(context.name)
+                if force
+                else _exists(self.storage, context.name)
+            )
+            if force or not already_exists:
+                pending.append((index, context, already_exists))
 
-        context = self._process_context(processors)
-        if not context.name:
+        if pending and (saved := self._generate(names, pending, executor)):
+            self._record(saved)
+        return names
+
+    def _process_or_defer(self, processors, *, silent=False):
+        if (batch := _batch.get()) is not None:
+            batch.requests.append((self, processors, silent))
+            return
+        if settings.IMAGEFIELD_EXISTS_CACHE:
+            key = None
+        elif cache.get(key := cache_key(self._process_context(processors).name)):
+            # The versatile image proxy and the widget always used the cache
             return
+        try:
+            name = self.process(processors)
+        except Exception:
+            if not silent:
+                raise
+            return
+        if key and name == self._process_context(processors).name:
+            cache.set(key, 1, timeout=cache_timeout())
 
-        logger.debug(
-            'Processing image "%(image)s" as "%(key)s" with context %(context)s',
-            {"image": self, "key": spec, "context": context},
+    async def aprocess(self, spec, *, force=False):
+        return (await self.aprocess_many([spec], force=force))[0]
+
+    async def aprocess_many(self, specs, *, force=False, executor=None):
+        """
+        Asynchronous variant of ``process_many``
+
+        The existence of processed images is checked concurrently, images are
+        rendered and saved in a thread.
+        """
+        names, contexts = self._contexts(specs)
+        exists = await asyncio.gather(
+            *(
+                sync_to_async(self.storage.exists, thread_sensitive=False)(context.name)
+                if force
+                else _aexists(self.storage, context.name)
+                for _index, context in contexts
+            )
         )
+        pending = [
+            (index, context, already_exists)
+            for (index, context), already_exists in zip(contexts, exists)
+            if force or not already_exists
+        ]
 
-        already_exists = self.storage.exists(context.name)
+        if pending and (
+            saved := await sync_to_async(self._generate, thread_sensitive=False)(
+                names, pending, executor
+            )
+        ):
+            await sync_to_async(self._record)(saved)
+        return names
+
+    async def aurl(self, spec):
+        """
+        Process the spec if necessary and return the URL of the processed image
+        """
+        name = await self.aprocess(spec)
+        return self.storage.url(name) if name else ""
+
+    def _contexts(self, specs):
+        names = []
+        contexts = []
+        for spec in specs:
+            processors, key = self._spec_processors(spec)
+            context = self._process_context(processors)
+            names.append(context.name or None)
+            if not context.name:
+                continue
+
+            logger.debug(
+                'Processing image "%(image)s" as "%(key)s" with context %(context)s',
+                {"image": self, "key": key, "context": context},
+            )
+            contexts.append((len(names) - 1, context))
+        return names, contexts
 
-        if not force and already_exists:
-            return context.name
+    def _generate(self, names, pending, executor):
+        """
+        Render and save pending processed images, returns the pending entries
+        which have been saved
 
+        If processing fails silently the specs are rendered one by one so that
+        only the failing specs fall back to the source image.
+        """
         try:
-            buf = self._process(context=context)
+            buffers = self._process_many(
+                [context for _i, context, _e in pending], executor=executor
+            )
+        except Exception:
+            logger.exception(
+                'Exception while processing "%(contexts)s"',
+                {"contexts": [context for _i, context, _e in pending]},
+            )
+            if not settings.IMAGEFIELD_SILENTFAILURE:
+                raise
+            buffers = [
+                self._generate_one(names, index, context, executor)
+                for index, context, _e in pending
+            ]
+
+        saved = []
+        for entry, buf in zip(pending, buffers):
+            if buf is None:
+                continue
+            _index, context, already_exists = entry
+            if already_exists:
+                self.storage.delete(context.name)
+            self.storage.save(context.name, ContentFile(buf))
+            if settings.IMAGEFIELD_EXISTS_CACHE:
+                _remember_exists(context.name)
+            logger.info('Saved "%(name)s" successfully', {"name": context.name})
+            saved.append(entry)
+        return saved
+
+    def _generate_one(self, names, index, context, executor):
+        # Forget the save keyword arguments of the failed attempt
+        context.save_kwargs.clear()
+        try:
+            return self._process_many([context], executor=executor)[0]
         except Exception:
             logger.exception(
                 'Exception while processing "%(context)s"', {"context": context}
             )
-            if settings.IMAGEFIELD_SILENTFAILURE:
-                return self.name
-            raise
+            names[index] = self.name
+            return None
 
-        if already_exists:
-            self.storage.delete(context.name)
-        self.storage.save(context.name, ContentFile(buf))
+    def _record(self, pending):
+        if settings.IMAGEFIELD_MANIFEST:
+            from imagefield.models import ProcessedImage
 
-        logger.info('Saved "%(name)s" successfully', {"name": context.name})
-        return context.name
+            ProcessedImage.objects.record([context for _i, context, _e in pending])
 
     def _process(self, processors=None, context=None):
         assert bool(processors) != bool(context), "Pass exactly one, not both"
@@ -238,44 +739,109 @@ class ImageFieldFile(files.ImageFieldFile):
             context = Context(
                 ppoi=self._ppoi(),
                 save_kwargs={},
+                extension=os.path.splitext(self.name)[1],
                 processors=processors,
                 source=self.name,
             )
             context.seal()
 
+        return self._process_many([context])[0]
+
+    def _process_many(self, contexts, executor=None):
+        # All contexts belong to this file and therefore share the source.
         orig_name = self.name
-        self.name = context.source
+        self.name = contexts[0].source
         try:
             with self.open("rb") as file:
                 image = Image.open(file)
-                context.save_kwargs.setdefault("format", image.format)
-
-                handler = build_handler(context.processors)
-                image = handler(image, context)
-
-                with io.BytesIO() as buf:
-                    _safe_image_save(image, buf, **context.save_kwargs)
-                    return buf.getvalue()
-
+                # Sources which already satisfy the spec are copied without
+                # decoding and encoding them, only their metadata is removed
+                passthrough = [
+                    settings.IMAGEFIELD_PASSTHROUGH
+                    and is_passthrough(context.processors, image, context.extension)
+                    for context in contexts
+                ]
+                if any(passthrough):
+                    file.seek(0)
+                    source = strip_metadata(file.read(), image.format)
+                    if source is None:
+                        passthrough = [False] * len(passthrough)
+                contexts = [
+                    context
+                    for context, passes in zip(contexts, passthrough)
+                    if not passes
+                ]
+                if contexts:
+                    draft(image, [context.processors for context in contexts])
+                    image.load()
         finally:
             self.name = orig_name
 
+        buffers = iter(self._render_many(image, contexts, executor))
+        return [source if passes else next(buffers) for passes in passthrough]
+
+    def _render_many(self, image, contexts, executor):
+        # Specs starting with the "default" processor share the work done by
+        # it; the processors following it only get to see its result.
+        # Transcoded specs and ladder rungs share everything but the encoding
+        # respectively the final downscale. Rungs are downscaled from larger
+        # rungs and are therefore prepared in descending order of widths.
+        shared = {}
+        renderings = [None] * len(contexts)
+        for index in sorted(
+            range(len(contexts)),
+            key=lambda index: -_ladder_width(contexts[index].processors),
+        ):
+            context = contexts[index]
+            context.save_kwargs.setdefault("format", image.format)
+
+            prefix, rest = _split_shared(context.processors)
+            if prefix and context.save_kwargs == {"format": image.format}:
+                key = compiled(prefix).spec
+                if key not in shared:
+                    shared[key] = _SharedPrefix(image, context, prefix)
+                context.save_kwargs.update(shared[key].save_kwargs)
+                if width := _ladder_width(context.processors):
+                    rung = build_handler(rest)(shared[key].rung_source(width), context)
+                    shared[key].rungs.append(rung)
+                    renderings[index] = (build_handler([]), rung, context)
+                else:
+                    renderings[index] = (
+                        build_handler(rest),
+                        shared[key].image,
+                        context,
+                    )
+            else:
+                renderings[index] = (build_handler(context.processors), image, context)
+
+        return (executor or render_executor()).map(
+            _render,
+            renderings,
+            [image_cost(source) for _handler, source, _context in renderings],
+        )
+
     @property
     def _image(self):
         if self.name:
-            original = io.BytesIO()
+            # Validate straight from the file instead of copying its contents
+            # into memory first
             if self.closed:
                 self.open("rb")
-            original.write(self.read())
             self.seek(0)
-            original.seek(0)
-            self.__dict__["_image"] = verified(Image.open(original))
+            try:
+                self.__dict__["_image"] = verified(Image.open(self))
+            finally:
+                self.seek(0)
 
         return self.__dict__.get("_image")
 
     def save(self, name, content, save=True):  # noqa: FBT002
+        digest = _content_digest(content) if self.field.digest_field else ""
+
         if not settings.IMAGEFIELD_VALIDATE_ON_SAVE:
-            super().save(name, content, save=True)
+            super().save(name, content, save=False)
+            self._set_digest(digest)
+            self.instance.save()
             return
 
         img = verified(Image.open(content))
@@ -285,6 +851,7 @@ class ImageFieldFile(files.ImageFieldFile):
         name = self.field.generate_filename(self.instance, name)
         self.name = self.storage.save(name, content, max_length=self.field.max_length)
         setattr(self.instance, self.field.name, self.name)
+        self._set_digest(digest)
         self._committed = True
 
         if save:
@@ -292,19 +859,62 @@ class ImageFieldFile(files.ImageFieldFile):
 
     save.alters_data = True
 
+    def _set_digest(self, digest):
+        # The digest is stored together with a check of the name it has been
+        # computed for
+        if self.field.digest_field:
+            setattr(
+                self.instance,
+                self.field.digest_field,
+                f"{digest}:{hashdigest(self.name)[:8]}",
+            )
+
     def delete(self, save=True):  # noqa: FBT002
-        filename = self.name
+        filename, digest = self.name, self._digest()
+        if self.field.digest_field:
+            setattr(self.instance, self.field.digest_field, "")
 
         super().delete(save=save)
 
-        self.field._clear_generated_files_for(self, filename)
+        self.field._clear_generated_files_for(self, filename, digest)
 
     delete.alters_data = True
 
 
-def verified(img):
-    # Anything which exercises the machinery so that we may
-    # find out whether the image works at all (or not)
+def verified(img, level=None):
+    """
+    Exercise the machinery so that we may find out whether the image works at
+    all (or not)
+
+    The ``level`` defaults to the ``IMAGEFIELD_VALIDATION`` setting:
+
+    - ``"header"``: Only check the size of the image.
+    - ``"decode"``: Also decode the image data. JPEGs are decoded at the
+      smallest scale supported by the decoder (see ``Image.draft``) which
+      still reads all of the image data but is much cheaper than a full
+      decode; the returned image is smaller than the source then.
+    - ``"paranoid"``: Also decode at full resolution, resize, convert and
+      encode the image in several formats.
+    """
+    level = level or settings.IMAGEFIELD_VALIDATION
+    if level not in {"header", "decode", "paranoid"}:
+        raise ImproperlyConfigured(f"Unknown image validation level {level!r}")
+
+    if Image.MAX_IMAGE_PIXELS and img.width * img.height > Image.MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(
+            f"Image size ({img.width * img.height} pixels) exceeds limit of"
+            f" {Image.MAX_IMAGE_PIXELS} pixels"
+        )
+    if level == "header":
+        return img
+
+    if level == "decode":
+        img.draft(img.mode, (1, 1))
+        img.load()
+        return img
+
+    img.load()
+
     thumb = img.resize((10, 10)).convert("RGB")
     with io.BytesIO() as target:
         _safe_image_save(thumb, target, format=img.format)
@@ -333,6 +943,7 @@ class ImageField(models.ImageField):
         self._fallback = kwargs.pop("fallback", "")
         self._formats = kwargs.pop("formats", {})
         self.ppoi_field = kwargs.pop("ppoi_field", None)
+        self.digest_field = kwargs.pop("digest_field", None)
         super().__init__(*args, **kwargs)
 
     @cached_property
@@ -345,6 +956,14 @@ class ImageField(models.ImageField):
     def formats(self):
         return settings.IMAGEFIELD_FORMATS.get(self.field_label, self._formats)
 
+    def _autogenerate(self):
+        autogenerate = settings.IMAGEFIELD_AUTOGENERATE
+        return (
+            autogenerate is True
+            or bool(autogenerate)
+            and (self.field_label in autogenerate)
+        )
+
     def deconstruct(self):
         name, _path, args, kwargs = super().deconstruct()
         return (name, "django.db.models.ImageField", args, kwargs)
@@ -374,12 +993,13 @@ class ImageField(models.ImageField):
         kwargs["widget"] = with_preview_and_ppoi(
             kwargs.get("widget", ClearableFileInput),
             ppoi_field=self.ppoi_field,
-            processors=self.formats.get(
-                "preview", ["default", ("thumbnail", (300, 300))]
-            ),
+            processors=self._preview_spec(),
         )
         return super().formfield(**kwargs)
 
+    def _preview_spec(self):
+        return self.formats.get("preview", ["default", ("thumbnail", (300, 300))])
+
     def save_form_data(self, instance, data):
         try:
             super().save_form_data(instance, data)
@@ -408,19 +1028,17 @@ class ImageField(models.ImageField):
         if getattr(instance, "_skip_generate_files", False):
             return
 
-        f = getattr(instance, self.name)
-
-        if f.name:
-            for spec in f.field.formats:
-                f.process(spec)
+        if getattr(instance, self.name).name:
+            generation_backend().generate(self, instance)
 
     def _clear_generated_files(self, instance, **kwargs):
         self._clear_generated_files_for(getattr(instance, self.name), None)
 
-    def _clear_generated_files_for(self, fieldfile, filename):
+    def _clear_generated_files_for(self, fieldfile, filename, digest=None):
         filename = fieldfile.name if filename is None else filename
+        digest = fieldfile._digest() if digest is None else digest
 
-        if not filename:
+        if not filename or (digest and _digest_in_use(digest, fieldfile.instance)):
             return
 
         key = (
@@ -429,17 +1047,39 @@ class ImageField(models.ImageField):
         )
         cache.delete(key)
 
-        base = fieldfile._process_base(filename)
+        base = fieldfile._process_base(filename, digest)
+        if settings.IMAGEFIELD_MANIFEST:
+            from imagefield.models import ProcessedImage
 
-        try:
-            folders, files = fieldfile.storage.listdir(base.path)
-        except FileNotFoundError:
-            # Fine!
+            # The manifest only records one of the sources sharing processed
+            # images, those are found using the digest in their names
+            names = (
+                ProcessedImage.objects.names_with_prefix(f"{base.path}/{base.basename}")
+                if digest
+                else ProcessedImage.objects.names_for_source(filename)
+            )
+        else:
+            try:
+                folders, files = fieldfile.storage.listdir(base.path)
+            except FileNotFoundError:
+                # Fine!
+                files = []
+            names = [
+                os.path.join(base.path, file)
+                for file in files
+                if file.startswith(base.basename)
+            ]
+        if not names:
             return
+        names = sorted(names)
+
+        for name in names:
+            fieldfile.storage.delete(name)
+        _forget_exists(names)
+        if settings.IMAGEFIELD_MANIFEST:
+            from imagefield.models import ProcessedImage
 
-        for file in files:
-            if file.startswith(base.basename):
-                fieldfile.storage.delete(os.path.join(base.path, file))
+            ProcessedImage.objects.filter(name__in=names).delete()
 
     def check(self, **kwargs):
         errors = super().check(**kwargs)
@@ -478,14 +1118,8 @@ class ImageField(models.ImageField):
 
 def _register_signal_handlers(sender, **kwargs):
     for field in IMAGEFIELDS:
-        if issubclass(sender, field.model):
-            autogenerate = settings.IMAGEFIELD_AUTOGENERATE
-            if (
-                autogenerate is True
-                or autogenerate
-                and field.field_label in autogenerate
-            ):
-                signals.post_save.connect(field._generate_files, sender=sender)
+        if issubclass(sender, field.model) and field._autogenerate():
+            signals.post_save.connect(field._generate_files, sender=sender)
 
 
 signals.class_prepared.connect(_register_signal_handlers)
@@ -506,16 +1140,137 @@ class PPOIField(models.CharField):
         return super().formfield(**kwargs)
 
 
-def _safe_image_save(image, fp, **kwargs):
-    original = ImageFile.MAXBLOCK
+def _render(rendering):
+    handler, source, context = rendering
+    image = handler(source, context)
+    if image is source:
+        # Saving sets attributes on the image, do not share it between threads
+        image = image.copy()
+    save_kwargs = dict(
+        context.save_kwargs,
+        **encoder_options(context.processors, context.save_kwargs["format"]),
+    )
+    target_bytes = save_kwargs.pop("target_bytes", None)
+    min_quality = save_kwargs.pop("min_quality", MIN_QUALITY)
+    if target_bytes and save_kwargs["format"] in LOSSY_FORMATS:
+        return _encode_for_size(image, save_kwargs, target_bytes, min_quality)
+    return _encode(image, save_kwargs)
+
+
+def _encode(image, save_kwargs):
+    with io.BytesIO() as buf:
+        _safe_image_save(image, buf, **save_kwargs)
+        return buf.getvalue()
+
+
+def _encode_for_size(image, save_kwargs, target_bytes, min_quality):
+    """
+    Return the encoding of the highest quality not exceeding ``target_bytes``
+
+    Only re-encodes the already processed image. Returns the encoding at
+    ``min_quality`` if even that is too large.
+    """
+    high = save_kwargs.get("quality", 95)
+    data = _encode(image, dict(save_kwargs, quality=high))
+    if len(data) <= target_bytes:
+        return data
+
+    best, low, high = None, min_quality, high - 1
+    while low <= high:
+        quality = (low + high) // 2
+        data = _encode(image, dict(save_kwargs, quality=quality))
+        if len(data) <= target_bytes:
+            best, low = data, quality + 1
+        else:
+            high = quality - 1
+    # The last attempt used min_quality if no encoding was small enough
+    return best or data
+
+
+def _content_digest(content):
+    digest = hashlib.sha1()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def _digest_in_use(digest, instance):
+    """
+    Return whether other objects still reference a source with this digest
+    """
+    for field in _imagefields_by_label().values():
+        if not field.digest_field:
+            continue
+        queryset = field.model._base_manager.filter(
+            **{f"{field.digest_field}__startswith": f"{digest}:"}
+        )
+        if isinstance(instance, field.model):
+            queryset = queryset.exclude(pk=instance.pk)
+        if queryset.exists():
+            return True
+    return False
+
+
+class _SizedImageFile:
+    """
+    ``PIL.ImageFile`` for the JPEG save handler below, encoding into a buffer
+    of at least ``_jpeg_bufsize`` bytes
+    """
+
+    def __getattr__(self, name):
+        return getattr(ImageFile, name)
+
+    @staticmethod
+    def _save(im, fp, tile, bufsize=0):
+        ImageFile._save(im, fp, tile, max(bufsize, _jpeg_bufsize.get()))
+
+
+_jpeg_bufsize = contextvars.ContextVar("imagefield_jpeg_bufsize", default=0)
+#: Pillow's JPEG save handler looking up ``ImageFile`` in a copy of its
+#: module's globals, registered under a private format name
+_SIZED_JPEG = "IMAGEFIELD_SIZED_JPEG"
+Image.register_save(
+    _SIZED_JPEG,
+    types.FunctionType(
+        JpegImagePlugin._save.__code__,
+        {**vars(JpegImagePlugin), "ImageFile": _SizedImageFile()},
+        JpegImagePlugin._save.__name__,
+        JpegImagePlugin._save.__defaults__,
+        JpegImagePlugin._save.__closure__,
+    ),
+)
 
+
+def _safe_image_save(image, fp, **kwargs):
+    """
+    Save the image, sizing the encoding buffer of JPEGs up front
+
+    Progressive and optimized JPEGs have to be encoded in one go into a buffer
+    which Pillow sizes using the dimensions and the mode of the image. The
+    estimate is not sufficient for e.g. CMYK images or noisy images at high
+    qualities without chroma subsampling. The buffer is sized for the worst
+    case instead, without touching process-global state such as
+    ``ImageFile.MAXBLOCK`` and without retrying, so errors of ``fp``
+    propagate.
+    """
+    if kwargs.get("format", image.format) != "JPEG" or not (
+        kwargs.get("progressive") or kwargs.get("progression") or kwargs.get("optimize")
+    ):
+        image.save(fp, **kwargs)
+        return
+    bufsize = (
+        image.width * image.height * len(image.getbands()) * JPEG_BYTES_PER_SAMPLE
+        + 65536
+        + sum(
+            len(value)
+            for key in ("icc_profile", "exif", "comment")
+            if isinstance(value := kwargs.get(key), bytes | str)
+        )
+    )
+    token = _jpeg_bufsize.set(bufsize)
     try:
-        try:
-            image.save(fp, **kwargs)
-        except OSError:
-            # Increase MAXBLOCK temporarily and try again.
-            # See https://github.com/python-imaging/Pillow/issues/148
-            ImageFile.MAXBLOCK *= 16
-            image.save(fp, **kwargs)
+        image.save(fp, **{**kwargs, "format": _SIZED_JPEG})
     finally:
-        ImageFile.MAXBLOCK = original
+        _jpeg_bufsize.reset(token)
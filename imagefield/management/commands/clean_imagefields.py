@@ -0,0 +1,209 @@
+import hashlib
+import math
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from imagefield.fields import _forget_exists, _imagefields_by_label
+from imagefield.models import ProcessedImage
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove processed images which do not belong to any source image and"
+        " format anymore."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report orphaned processed images, do not delete them.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Count of processed images deleted at once.",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Maximum count of processed images deleted per second.",
+        )
+        parser.add_argument(
+            "--unused-formats",
+            action="store_true",
+            help=(
+                "Also delete processed images of existing source images which"
+                " belong to none of their formats or the preview, e.g. of"
+                " removed formats or of the versatile image proxy."
+            ),
+        )
+        parser.add_argument(
+            "--scan",
+            choices=["auto", "manifest", "storage"],
+            default="auto",
+            help=(
+                "Find processed images using the manifest or by listing the"
+                " storage. Defaults to the manifest if IMAGEFIELD_MANIFEST is"
+                " enabled."
+            ),
+        )
+
+    def handle(self, **options):
+        started = timezone.now()
+        fields = _imagefields_by_label().values()
+        live = _Live(fields, options["unused_formats"])
+        # Storages serving the same URLs share their files
+        storages = list(
+            {
+                field.storage.url("__processed__"): field.storage for field in fields
+            }.values()
+        )
+
+        scan = options["scan"]
+        if scan == "auto":
+            scan = "manifest" if settings.IMAGEFIELD_MANIFEST else "storage"
+        if scan == "manifest":
+            orphans = _manifest_orphans(live, started)
+        else:
+            orphans = _storage_orphans(storages, live, started)
+
+        count = 0
+        while batch := list(islice(orphans, options["batch_size"])):
+            count += len(batch)
+            if options["verbosity"] > 1:
+                self.stdout.write("\n".join(batch))
+            if options["dry_run"]:
+                continue
+
+            batch_started = time.monotonic()
+            for storage in storages:
+                for name in batch:
+                    storage.delete(name)
+            _forget_exists(batch)
+            ProcessedImage.objects.filter(name__in=batch).delete()
+            if options["rate"]:
+                time.sleep(
+                    max(
+                        0,
+                        len(batch) / options["rate"]
+                        - (time.monotonic() - batch_started),
+                    )
+                )
+
+        if options["verbosity"]:
+            self.stdout.write(
+                "{} {} orphaned processed images.".format(
+                    "Found" if options["dry_run"] else "Deleted", count
+                )
+            )
+
+
+class _Live:
+    """
+    Bloom filters of the processed images of all existing source images, and
+    optionally of the names of all their formats
+
+    False positives only mean that some orphans are kept, and the filters
+    need far less memory than sets of all names. Processed images of existing
+    sources are only orphans if ``formats`` is set since the names of
+    renditions of the versatile image proxy or ad hoc specs are unknown.
+    """
+
+    def __init__(self, fields, formats):
+        querysets = [
+            (field, field.model._base_manager.exclude(**{field.name: ""}))
+            for field in fields
+        ]
+        counts = [(field, queryset.count() + 1) for field, queryset in querysets]
+        self.sources = _BloomFilter(sum(count for _field, count in counts))
+        self.names = (
+            _BloomFilter(
+                sum(count * (len(field.formats) + 1) for field, count in counts)
+            )
+            if formats
+            else None
+        )
+        for field, queryset in querysets:
+            instances = queryset.iterator(chunk_size=2000)
+            if field._fallback:
+                instances = [field.model(), *instances]
+            specs = [*field.formats.values(), field._preview_spec()]
+            for instance in instances:
+                fieldfile = getattr(instance, field.name)
+                name = fieldfile.name or field._fallback
+                base = fieldfile._process_base(name, fieldfile._digest())
+                self.sources.add(f"{base.path}/{base.basename}")
+                if self.names is not None:
+                    for spec in specs:
+                        if processed := fieldfile._process_context(spec).name:
+                            self.names.add(processed)
+
+    def __contains__(self, name):
+        prefix, _sep, _hash = name.rpartition("-")
+        if f"{prefix}-" not in self.sources:
+            return False
+        return self.names is None or name in self.names
+
+
+def _manifest_orphans(live, started):
+    queryset = ProcessedImage.objects.filter(created_at__lt=started).order_by("pk")
+    last = 0
+    while rows := list(queryset.filter(pk__gt=last).values_list("pk", "name")[:2000]):
+        last = rows[-1][0]
+        yield from (name for _pk, name in rows if name not in live)
+
+
+def _storage_orphans(storages, live, started):
+    for storage in storages:
+        for name in _walk(storage, "__processed__"):
+            if name in live:
+                continue
+            # Skip processed images of sources uploaded during the run
+            try:
+                if storage.get_modified_time(name) >= started:
+                    continue
+            except NotImplementedError:
+                pass
+            yield name
+
+
+def _walk(storage, path):
+    try:
+        directories, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for file in files:
+        yield f"{path}/{file}"
+    for directory in directories:
+        yield from _walk(storage, f"{path}/{directory}")
+
+
+class _BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1000)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "little")
+        b = int.from_bytes(digest[8:], "little") | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from imagefield.backends import QueueBackend
+
+
+class Command(BaseCommand):
+    help = "Generate processed images queued by the QueueBackend."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Count of tasks processed per transaction.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep waiting for new tasks instead of exiting when the queue is empty.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait between checks for new tasks when looping.",
+        )
+
+    def handle(self, **options):
+        backend = QueueBackend()
+        while True:
+            while count := backend.drain(batch_size=options["batch_size"]):
+                if options["verbosity"]:
+                    self.stdout.write(f"Processed {count} tasks")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
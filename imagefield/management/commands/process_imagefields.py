@@ -1,11 +1,20 @@
+import json
 import multiprocessing as mp
+import os
 import sys
+from collections import defaultdict
 from fnmatch import fnmatch
 from functools import partial
+from itertools import islice
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
-from imagefield.fields import IMAGEFIELDS
+from imagefield.fields import IMAGEFIELDS, _imagefields_by_label
+from imagefield.models import ProcessedImage
+from imagefield.rendering import render_executor
 
 
 class Command(BaseCommand):
@@ -31,6 +40,54 @@ class Command(BaseCommand):
             dest="no_parallel",
             help="Process images sequentially without parallelization.",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Count of worker processes. Defaults to the count of CPUs.",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=None,
+            help=(
+                "Count of threads rendering the formats of an image in every"
+                " worker. Defaults to the IMAGEFIELD_RENDER_WORKERS setting."
+            ),
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="Count of objects sent to a worker at once.",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help=(
+                "Only process formats missing from the manifest. Requires the"
+                " IMAGEFIELD_MANIFEST setting."
+            ),
+        )
+        parser.add_argument(
+            "--pk-range",
+            default="",
+            help=(
+                "Only process objects with primary keys in the range START:END"
+                " (START inclusive, END exclusive, both optional). Allows"
+                " sharding runs across several machines."
+            ),
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default="",
+            help="Record the last processed primary key per field in this file.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue where the run recorded in --checkpoint stopped.",
+        )
         parser.add_argument(
             "field",
             nargs="*",
@@ -40,13 +97,16 @@ class Command(BaseCommand):
             ),
         )
 
-        # TODO --clear for removing previously generated images.
-
     def handle(self, **options):
         self._fields = self._compile_imagefield_labels(options)
+        if options["resume"] and not options["checkpoint"]:
+            raise CommandError("--resume requires --checkpoint.")
+        if options["incremental"] and not settings.IMAGEFIELD_MANIFEST:
+            raise CommandError("--incremental requires IMAGEFIELD_MANIFEST = True.")
+        self._checkpoints = _Checkpoints(options["checkpoint"])
 
-        for field in sorted(IMAGEFIELDS, key=lambda f: f.field_label):
-            if field.field_label in self._fields:
+        for label, field in sorted(_imagefields_by_label().items()):
+            if label in self._fields:
                 self._process_field(field, options)
 
     def _compile_imagefield_labels(self, options):
@@ -75,6 +135,17 @@ class Command(BaseCommand):
         queryset = field.model._default_manager.exclude(**{field.name: ""}).order_by(
             "-pk"
         )
+        to_python = field.model._meta.pk.to_python
+        start, end = _parse_pk_range(options["pk_range"], to_python)
+        if start is not None:
+            queryset = queryset.filter(pk__gte=start)
+        if end is not None:
+            queryset = queryset.filter(pk__lt=end)
+
+        checkpoint_key = f"{field.field_label}:{options['pk_range']}"
+        if options["resume"] and (checkpoint := self._checkpoints.get(checkpoint_key)):
+            queryset = queryset.filter(pk__lt=to_python(checkpoint))
+
         count = queryset.count()
         self.stdout.write(
             "{} - {} objects - {}".format(
@@ -86,7 +157,7 @@ class Command(BaseCommand):
         self.stdout.write("\r|{}| {}/{}".format(" " * 50, 0, count), ending="")
 
         if field._fallback:
-            self._process_instance(
+            _process_instance(
                 field.model(),
                 field,
                 housekeep=None,
@@ -94,65 +165,178 @@ class Command(BaseCommand):
             )
 
         fn = partial(
-            _process_instance,
+            _process_pks,
             field=field,
             housekeep=options.get("housekeep"),
             force=options.get("force"),
+            incremental=options["incremental"],
+            threads=options["threads"],
+        )
+        chunks = _chunked(
+            queryset.values_list("pk", flat=True).iterator(
+                chunk_size=options["chunk_size"]
+            ),
+            options["chunk_size"],
         )
 
         if options.get("no_parallel"):
-            for index, (instance, errors) in enumerate(
-                map(fn, queryset.iterator(chunk_size=100))
-            ):
-                if errors:
-                    self.stderr.write("\n".join(errors))
-
-                progress = "*" * (50 * index // count)
-                self.stdout.write(
-                    f"\r|{progress.ljust(50)}| {index + 1}/{count}", ending=""
-                )
-
-                # Save instance once for good measure; fills in width/height
-                # if not done already
-                instance._skip_generate_files = True
-                instance.save()
+            self._report(map(fn, chunks), count, checkpoint_key)
         else:
-            pool = mp.Pool()
+            # Worker processes have to open their own database connections
+            connections.close_all()
+            pool = mp.Pool(options["workers"])
             try:
-                for index, (instance, errors) in enumerate(
-                    pool.imap(fn, queryset.iterator(chunk_size=100))
-                ):
-                    if errors:
-                        self.stderr.write("\n".join(errors))
-
-                    progress = "*" * (50 * index // count)
-                    self.stdout.write(
-                        f"\r|{progress.ljust(50)}| {index + 1}/{count}", ending=""
-                    )
-
-                    # Save instance once for good measure; fills in width/height
-                    # if not done already
-                    instance._skip_generate_files = True
-                    instance.save()
-
+                self._report(pool.imap(fn, chunks), count, checkpoint_key)
             finally:
                 pool.close()
                 pool.join()
 
         self.stdout.write("\r|{}| {}/{}".format("*" * 50, count, count))
 
+    def _report(self, results, count, checkpoint_key):
+        done = 0
+        # Chunks are processed in descending primary key order and results
+        # are returned in the same order.
+        for last_pk, processed, errors in results:
+            if errors:
+                self.stderr.write("\n".join(errors))
 
-def _process_instance(instance, field, housekeep, **kwargs):
+            self._checkpoints.set(checkpoint_key, last_pk)
+            done += processed
+            progress = "*" * (50 * done // count)
+            self.stdout.write(f"\r|{progress.ljust(50)}| {done}/{count}", ending="")
+
+
+def _parse_pk_range(value, to_python):
+    if not value:
+        return None, None
+    try:
+        start, end = value.split(":")
+        return (
+            to_python(start) if start else None,
+            to_python(end) if end else None,
+        )
+    except (ValueError, ValidationError) as exc:
+        raise CommandError(f"Invalid --pk-range {value!r}") from exc
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _process_pks(pks, field, housekeep, *, incremental=False, threads=None, **kwargs):
+    """
+    Process the images of the given primary keys and write back dimensions
+    which were missing and blanked images
+
+    Runs in worker processes; only primary keys are sent to the workers and
+    only counts and error messages are sent back.
+    """
+    kwargs["executor"] = render_executor(threads)
+    dimension_fields = [f for f in (field.width_field, field.height_field) if f]
+    queryset = field.model._base_manager.filter(pk__in=pks)
+    stored = {row[0]: row[1:] for row in queryset.values_list("pk", *dimension_fields)}
+    instances = list(queryset)
+    missing = _missing_contexts(field, instances) if incremental else None
+
+    changed = []
+    blanked = []
+    errors = []
+    for instance in instances:
+        if missing is None:
+            _names, instance_errors = _process_instance(
+                instance, field, housekeep, **kwargs
+            )
+        else:
+            contexts = missing.get(instance.pk, {})
+            names, instance_errors = _process_instance(
+                instance, field, housekeep, formats=list(contexts), **kwargs
+            )
+            # Record processed images which existed already too
+            ProcessedImage.objects.record(
+                [
+                    context
+                    for name, context in zip(names, contexts.values())
+                    if name == context.name
+                ]
+            )
+
+        if instance_errors:
+            errors.extend(instance_errors)
+        if not getattr(instance, field.name).name:
+            blanked.append(instance)
+        elif stored[instance.pk] != tuple(
+            getattr(instance, f) for f in dimension_fields
+        ):
+            # Dimensions have been filled in when the instance was loaded
+            changed.append(instance)
+
+    if changed:
+        field.model._base_manager.bulk_update(changed, dimension_fields)
+    if blanked:
+        field.model._base_manager.bulk_update(
+            blanked,
+            [f for f in (field.name, field.ppoi_field, *dimension_fields) if f],
+        )
+
+    return pks[-1], len(pks), errors
+
+
+def _missing_contexts(field, instances):
+    """
+    Return the processing contexts of formats which are missing from the
+    manifest, keyed by primary key and format
+    """
+    contexts = {}
+    for instance in instances:
+        fieldfile = getattr(instance, field.name)
+        for key, spec in field.formats.items():
+            context = fieldfile._process_context(spec)
+            if context.name:
+                contexts[context.name] = (instance.pk, key, context)
+
+    missing = defaultdict(dict)
+    existing = ProcessedImage.objects.existing(contexts)
+    for name, (pk, key, context) in contexts.items():
+        if name not in existing:
+            missing[pk][key] = context
+    return missing
+
+
+class _Checkpoints:
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, pk):
+        if not self.path:
+            return
+        self.data[key] = str(pk)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.data, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def _process_instance(instance, field, housekeep, formats=None, **kwargs):
     fieldfile = getattr(instance, field.name)
-    for key in field.formats:
-        try:
-            fieldfile.process(key, **kwargs)
-        except Exception as exc:
-            if housekeep == "blank-on-failure":
-                field.save_form_data(instance, "")
-
-            return instance, [
-                f"Error while processing {fieldfile.name} ({field.field_label}, #{instance.pk}):\n{exc}\n"
-            ]
-
-    return instance, None
+    try:
+        names = fieldfile.process_many(
+            field.formats if formats is None else formats, **kwargs
+        )
+    except Exception as exc:
+        if housekeep == "blank-on-failure":
+            field.save_form_data(instance, "")
+
+        return [], [
+            f"Error while processing {fieldfile.name} ({field.field_label}, #{instance.pk}):\n{exc}\n"
+        ]
+
+    return names, None
@@ -0,0 +1,13 @@
+from imagefield.fields import batched_processing
+
+
+def batched_processing_middleware(get_response):
+    """
+    Processes images requested while handling the request in one batch
+    """
+
+    def middleware(request):
+        with batched_processing():
+            return get_response(request)
+
+    return middleware
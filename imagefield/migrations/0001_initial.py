@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:39
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="GenerationTask",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("field_label", models.CharField(max_length=200, verbose_name="field")),
+                ("object_pk", models.CharField(max_length=100, verbose_name="object")),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="created at"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "generation task",
+                "verbose_name_plural": "generation tasks",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("field_label", "object_pk"),
+                        name="imagefield_generationtask_unique",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:47
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("imagefield", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProcessedImage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(max_length=300, unique=True, verbose_name="name"),
+                ),
+                (
+                    "source",
+                    models.CharField(
+                        db_index=True, max_length=300, verbose_name="source"
+                    ),
+                ),
+                (
+                    "spec",
+                    models.CharField(
+                        db_index=True, max_length=40, verbose_name="spec hash"
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="created at"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "processed image",
+                "verbose_name_plural": "processed images",
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("imagefield", "0002_processedimage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="generationtask",
+            name="claimed_at",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="claimed at"
+            ),
+        ),
+    ]
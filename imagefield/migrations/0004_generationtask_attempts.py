@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("imagefield", "0003_generationtask_claimed_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="generationtask",
+            name="attempts",
+            field=models.PositiveIntegerField(
+                default=0, verbose_name="failed attempts"
+            ),
+        ),
+    ]
@@ -0,0 +1,95 @@
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+
+class GenerationTask(models.Model):
+    """
+    Pending generation of processed images, used by ``QueueBackend``
+    """
+
+    field_label = models.CharField(_("field"), max_length=200)
+    object_pk = models.CharField(_("object"), max_length=100)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    claimed_at = models.DateTimeField(_("claimed at"), blank=True, null=True)
+    attempts = models.PositiveIntegerField(_("failed attempts"), default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["field_label", "object_pk"],
+                name="imagefield_generationtask_unique",
+            )
+        ]
+        verbose_name = _("generation task")
+        verbose_name_plural = _("generation tasks")
+
+    def __str__(self):
+        return f"{self.field_label} #{self.object_pk}"
+
+
+class ProcessedImageQuerySet(models.QuerySet):
+    def record(self, contexts):
+        """
+        Record processed images using their processing contexts
+        """
+        self.bulk_create(
+            [
+                self.model(
+                    name=context.name, source=context.source, spec=context.spec_hash
+                )
+                for context in contexts
+            ],
+            ignore_conflicts=True,
+        )
+
+    def existing(self, names):
+        """
+        Return the subset of ``names`` which have been recorded
+        """
+        return set(self.filter(name__in=names).values_list("name", flat=True))
+
+    def resolve(self, name):
+        """
+        Return the source and the spec hash of a processed name or ``None``
+        """
+        return self.filter(name=name).values_list("source", "spec").first()
+
+    def names_for_source(self, source):
+        """
+        Return the processed names of a source
+        """
+        return list(self.filter(source=source).values_list("name", flat=True))
+
+    def names_with_prefix(self, prefix):
+        """
+        Return the processed names starting with ``prefix``
+        """
+        return list(self.filter(name__startswith=prefix).values_list("name", flat=True))
+
+    def names_for_spec(self, spec):
+        """
+        Return the processed names of a spec hash
+        """
+        return list(self.filter(spec=spec).values_list("name", flat=True))
+
+
+class ProcessedImage(models.Model):
+    """
+    Manifest of generated processed images, used if ``IMAGEFIELD_MANIFEST``
+    is enabled
+    """
+
+    name = models.CharField(_("name"), max_length=300, unique=True)
+    source = models.CharField(_("source"), max_length=300, db_index=True)
+    spec = models.CharField(_("spec hash"), max_length=40, db_index=True)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+
+    objects = ProcessedImageQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("processed image")
+        verbose_name_plural = _("processed images")
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,155 @@
+import mimetypes
+from collections import namedtuple
+
+from django.forms.utils import flatatt
+from django.utils.html import format_html, format_html_join
+from PIL import Image
+
+from imagefield.processing import keeps_scale, passes_through, register, scales
+
+
+_Encoding = namedtuple("_Encoding", "extensions content_type save_kwargs")
+
+#: Encodings processed images may be transcoded to. The first extension is
+#: used for processed images of sources with other extensions.
+ENCODINGS = {
+    "AVIF": _Encoding((".avif",), "image/avif", {"quality": 60}),
+    "WEBP": _Encoding((".webp",), "image/webp", {"quality": 80}),
+    "JPEG": _Encoding(
+        (".jpg", ".jpeg"), "image/jpeg", {"quality": 90, "progressive": True}
+    ),
+    "PNG": _Encoding((".png",), "image/png", {}),
+    "GIF": _Encoding((".gif",), "image/gif", {}),
+}
+#: Sources with these extensions keep their format in the fallback encoding,
+#: all other sources use JPEG
+FALLBACKS = {".png": "PNG", ".gif": "GIF"}
+
+
+@register
+@scales(keeps_scale)
+@passes_through(
+    lambda image, format: image.format == format
+    and (format != "JPEG" or image.mode == "RGB")
+)
+def transcode(get_image, format):
+    def processor(image, context):
+        image = get_image(image, context)
+
+        if format == "JPEG":
+            mode = "RGB"
+        elif format in {"AVIF", "WEBP"} and image.mode not in {"RGB", "RGBA"}:
+            mode = "RGBA" if image.has_transparency_data else "RGB"
+        else:
+            mode = image.mode
+        if image.mode != mode:
+            image = image.convert(mode)
+
+        if context.save_kwargs["format"] != format:
+            icc_profile = context.save_kwargs.get("icc_profile")
+            context.save_kwargs.clear()
+            context.save_kwargs.update(ENCODINGS[format].save_kwargs, format=format)
+            if icc_profile:
+                context.save_kwargs["icc_profile"] = icc_profile
+        return image
+
+    return processor
+
+
+def encoded(processors, format=None):
+    """
+    Return a spec which runs ``processors`` and encodes the result as
+    ``format``
+
+    ``None`` keeps PNG and GIF sources as they are and uses JPEG otherwise.
+    Specs for several formats of the same processors resize the source only
+    once when they are processed together.
+    """
+
+    def spec(fieldfile, context):
+        target = format or FALLBACKS.get(context.extension.lower(), "JPEG")
+        if context.extension.lower() not in ENCODINGS[target].extensions:
+            context.extension = ENCODINGS[target].extensions[0]
+        context.processors = [("transcode", target), *processors]
+
+    spec.cacheable = True
+    return spec
+
+
+def picture_formats(item, processors, formats=("AVIF", "WEBP")):
+    """
+    Return formats for ``ImageField(formats=...)`` rendering ``processors`` in
+    a fallback encoding and in modern formats
+
+    The fallback is available as ``item``, modern formats as e.g.
+    ``f"{item}_webp"``. Formats not supported by the installed Pillow are
+    skipped.
+    """
+    Image.init()
+    return {
+        item: encoded(processors),
+        **{
+            f"{item}_{format.lower()}": encoded(processors, format)
+            for format in formats
+            if format in Image.SAVE
+        },
+    }
+
+
+def picture_sources(fieldfile, item):
+    """
+    Return a list of ``(content_type, url)`` tuples of the encodings of
+    ``item`` in order of preference, the fallback comes last
+    """
+    sources = [
+        (encoding.content_type, getattr(fieldfile, f"{item}_{format.lower()}"))
+        for format, encoding in ENCODINGS.items()
+        if f"{item}_{format.lower()}" in fieldfile.field.formats
+    ]
+    url = getattr(fieldfile, item)
+    content_type, _encoding = mimetypes.guess_type(url)
+    return [*sources, (content_type or "application/octet-stream", url)]
+
+
+def picture_html(fieldfile, item, **attrs):
+    """
+    Return a ``<picture>`` element offering all encodings of ``item``
+
+    Keyword arguments are added as attributes to the ``<img>`` element.
+    """
+    *sources, (_content_type, url) = picture_sources(fieldfile, item)
+    return format_html(
+        '<picture>{}<img src="{}"{}></picture>',
+        format_html_join("", '<source type="{}" srcset="{}">', sources),
+        url,
+        flatatt(attrs),
+    )
+
+
+def _accepted_types(accept):
+    types = set()
+    for part in accept.split(","):
+        media_type, *params = (value.strip() for value in part.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _sep, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            types.add(media_type.lower())
+    return types
+
+
+def negotiate(fieldfile, item, accept):
+    """
+    Return the URL of the preferred encoding of ``item`` which is explicitly
+    listed in the ``Accept`` header ``accept``, or of the fallback
+
+    Responses containing the URL have to vary on the ``Accept`` header.
+    """
+    *sources, (_content_type, url) = picture_sources(fieldfile, item)
+    accepted = _accepted_types(accept)
+    return next((url for content_type, url in sources if content_type in accepted), url)
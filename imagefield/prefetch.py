@@ -0,0 +1,143 @@
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+
+from imagefield.fields import _exists_lru
+from imagefield.widgets import cache_key, cache_timeout
+
+
+def prefetch_formats(
+    instances,
+    field_name,
+    formats=None,
+    *,
+    check=False,
+    generate=False,
+    list_bins=False,
+):
+    """
+    Compute the URLs of processed images of many instances in one pass
+
+    The URLs of ``formats`` (defaults to all formats of the field) are stored
+    on the image field files so that accessing e.g. ``instance.image.thumb``
+    doesn't have to do any work anymore. If processed images are rendered on
+    demand by ``imagefield.views``, the sources of the processed images are
+    recorded for the view using one cache query.
+
+    If ``check`` is true, the existence of all processed images is looked up
+    using one cache query. Processed images missing from the cache are looked
+    up in the storage, either one by one or if ``list_bins`` is true by
+    listing the contents of their folders once. If ``generate`` is true,
+    missing processed images are generated as well.
+
+    Returns the set of processed names which didn't exist.
+    """
+    instances = list(instances)
+    if not instances:
+        return set()
+
+    field = instances[0]._meta.get_field(field_name)
+    formats = list(field.formats if formats is None else formats)
+    names = {}
+    fieldfiles = []
+    for instance in instances:
+        fieldfile = getattr(instance, field_name)
+        fieldfiles.append(fieldfile)
+        for item in formats:
+            context = fieldfile._process_context(field.formats[item])
+            setattr(
+                fieldfile,
+                item,
+                fieldfile.storage.url(context.name) if context.name else "",
+            )
+            if context.name:
+                names.setdefault(context.name, []).append((fieldfile, item))
+
+    if not field._autogenerate():
+        # Processed images are rendered on demand by imagefield.views which
+        # has to find the source
+        from imagefield.views import mounted, remember
+
+        if mounted():
+            remember(
+                [
+                    fieldfile
+                    for fieldfile in fieldfiles
+                    if not (fieldfile.name and fieldfile.instance._state.adding)
+                ],
+                formats,
+            )
+
+    if not (check or generate):
+        return set()
+
+    missing = _missing(field.storage, names, list_bins=list_bins)
+    if generate:
+        pending = {}
+        for name in missing:
+            for fieldfile, item in names[name]:
+                pending.setdefault(id(fieldfile), (fieldfile, []))[1].append(item)
+        for fieldfile, items in pending.values():
+            fieldfile.process_many(items, force=True)
+    return missing
+
+
+def _missing(storage, names, *, list_bins):
+    unknown = set(names)
+    if settings.IMAGEFIELD_EXISTS_CACHE:
+        unknown = {name for name in unknown if not _exists_lru.get(name)}
+        keys = {cache_key(name): name for name in unknown}
+        for key in cache.get_many(keys):
+            _exists_lru.set(keys[key], 1)
+            unknown.discard(keys[key])
+
+    if list_bins:
+        found = set()
+        for directory in {os.path.dirname(name) for name in unknown}:
+            try:
+                _directories, files = storage.listdir(directory)
+            except FileNotFoundError:
+                continue
+            found |= {f"{directory}/{file}" for file in files} & unknown
+    else:
+        found = {name for name in unknown if storage.exists(name)}
+
+    if found and settings.IMAGEFIELD_EXISTS_CACHE:
+        for name in found:
+            _exists_lru.set(name, 1)
+        cache.set_many({cache_key(name): 1 for name in found}, timeout=cache_timeout())
+    return unknown - found
+
+
+class ImageFieldQuerySet(models.QuerySet):
+    """
+    Adds ``prefetch_formats`` to querysets
+
+    Use ``ImageFieldQuerySet.as_manager()`` or inherit from this class.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._imagefield_prefetches = []
+
+    def prefetch_formats(self, field_name, formats=None, **kwargs):
+        """
+        Run ``prefetch_formats`` for all instances when evaluating the queryset
+        """
+        clone = self._chain()
+        clone._imagefield_prefetches.append((field_name, formats, kwargs))
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._imagefield_prefetches = self._imagefield_prefetches[:]
+        return clone
+
+    def _fetch_all(self):
+        fetch = self._result_cache is None
+        super()._fetch_all()
+        if fetch and self._iterable_class is models.query.ModelIterable:
+            for field_name, formats, kwargs in self._imagefield_prefetches:
+                prefetch_formats(self._result_cache, field_name, formats, **kwargs)
@@ -1,11 +1,35 @@
-from PIL import Image, ImageOps
+import math
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from PIL import ExifTags, Image, ImageOps
 
 
 PROCESSORS = {}
+#: Keys of ``Image.info`` containing metadata which is not copied when
+#: processing images, see ``is_passthrough``
+METADATA = {"comment", "exif", "photoshop", "xmp", "XML:com.adobe.xmp"}
+#: Formats whose quality may be reduced to reach a ``target_bytes`` size
+LOSSY_FORMATS = {"JPEG", "WEBP", "AVIF"}
+#: Images are decoded at least this much larger than the size they are
+#: resized to (see ``Image.thumbnail``)
+DRAFT_REDUCING_GAP = 2.0
+#: Passed to ``Image.resize``, uses ``Image.reduce`` for the first steps of
+#: large downscales
+RESIZE_REDUCING_GAP = 3.0
+#: Ladder rungs are downscaled from larger rungs which are at least this much
+#: larger than the rung, or from the full-size image
+LADDER_REDUCING_GAP = 2.0
+
+
+#: Maximum count of compiled pipelines kept around
+MAX_PIPELINES = 1024
+_PIPELINES = {}
 
 
 def build_handler(processors, handler=None):
-    handler = handler or (lambda image, context: image)
+    if handler is None:
+        return compiled(processors)
 
     for part in reversed(processors):
         if isinstance(part, list | tuple):
@@ -18,24 +42,333 @@ def build_handler(processors, handler=None):
 
 def register(fn):
     PROCESSORS[fn.__name__] = fn
+    _PIPELINES.clear()
     return fn
 
 
+def spec_key(processors):
+    """
+    Return a hashable key for a processors spec or ``None`` if the spec
+    contains unhashable values
+
+    Lists and tuples and equal values of different types such as ``1``,
+    ``1.0`` and ``True`` are distinguished because they result in different
+    processed names. Dicts are equal independent of their order, their
+    processed names are derived from the ``canonical`` spec.
+    """
+
+    def freeze(value):
+        if isinstance(value, list | tuple):
+            return (type(value), *map(freeze, value))
+        if isinstance(value, dict):
+            return (
+                dict,
+                *sorted(
+                    ((freeze(key), freeze(item)) for key, item in value.items()),
+                    key=lambda pair: repr(pair[0]),
+                ),
+            )
+        return (type(value), value)
+
+    key = freeze(processors)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def canonical(value):
+    """
+    Return ``value`` with the items of all dicts sorted by the ``repr`` of
+    their keys
+    """
+    if isinstance(value, list | tuple):
+        return type(value)(map(canonical, value))
+    if isinstance(value, dict):
+        return {
+            key: canonical(item)
+            for key, item in sorted(value.items(), key=lambda pair: repr(pair[0]))
+        }
+    return value
+
+
+class Pipeline:
+    """
+    A processors spec compiled into a handler
+
+    ``spec`` is the string representation of the processors used for
+    deriving processed names. The handler is built when the pipeline is
+    called for the first time.
+    """
+
+    def __init__(self, processors):
+        self.processors = processors
+        self.spec = "|".join(str(canonical(p)) for p in processors)
+        self._handler = None
+
+    def __call__(self, image, context):
+        if self._handler is None:
+            self._handler = build_handler(self.processors, lambda image, context: image)
+        return self._handler(image, context)
+
+
+def compiled(processors):
+    """
+    Return the ``Pipeline`` for a processors spec, reusing pipelines of
+    equal specs
+    """
+    if (key := spec_key(processors)) is None:
+        return Pipeline(processors)
+    if (pipeline := _PIPELINES.get(key)) is None:
+        if len(_PIPELINES) >= MAX_PIPELINES:
+            _PIPELINES.clear()
+        pipeline = _PIPELINES[key] = Pipeline(processors)
+    return pipeline
+
+
+def encoder_options(processors, format):
+    """
+    Return the options of all ``encoder`` processors in the spec which apply
+    to ``format``
+    """
+    options = {}
+    for part in processors:
+        if (
+            isinstance(part, list | tuple)
+            and part[0] == "encoder"
+            and part[1] in {None, format}
+        ):
+            options.update(part[2])
+    return options
+
+
+def scales(scale):
+    """
+    Declare how a processor changes the resolution of images
+
+    ``scale`` receives the size of the source image and the processor's
+    arguments and returns the factor by which the image will be resized, or
+    ``None`` if the processor doesn't care about the resolution at all.
+    """
+
+    def decorator(fn):
+        fn.scale = scale
+        return fn
+
+    return decorator
+
+
+def keeps_scale(size, *args):
+    return None
+
+
+def passes_through(check):
+    """
+    Declare when a processor leaves images unchanged
+
+    ``check`` receives the source image (which hasn't been loaded yet) and
+    the processor's arguments and returns whether the processor would
+    neither change the image nor its encoding.
+    """
+
+    def decorator(fn):
+        fn.passes_through = check
+        return fn
+
+    return decorator
+
+
+def unchanged(image, *args):
+    return True
+
+
+def is_passthrough(processors, image, extension=None):
+    """
+    Return whether the source image may be used as-is instead of processing
+    it
+
+    Only processors which declared their behavior using ``@passes_through``
+    are supported. Animated images, images whose format doesn't match the
+    ``extension`` of the processed name and images containing metadata
+    which cannot be removed using ``strip_metadata`` are always processed.
+    """
+    if getattr(image, "is_animated", False):
+        return False
+    if extension is not None and (
+        Image.registered_extensions().get(extension.lower()) != image.format
+    ):
+        return False
+    if image.format not in _STRIPPERS and (
+        image.format == "TIFF" or METADATA.intersection(image.info)
+    ):
+        # TIFF tags may contain all kinds of metadata
+        return False
+    for part in processors:
+        name, args = (
+            (part[0], part[1:]) if isinstance(part, list | tuple) else (part, ())
+        )
+        check = getattr(PROCESSORS[name], "passes_through", None)
+        if check is None or not check(image, *args):
+            return False
+    return True
+
+
+def strip_metadata(data, format):
+    """
+    Return the encoded image ``data`` without metadata such as EXIF, XMP and
+    comments, or ``None`` if the data cannot be parsed
+
+    The image data itself is copied as-is, ICC profiles are kept. Data in
+    formats other than JPEG and PNG is returned unchanged.
+    """
+    if (stripper := _STRIPPERS.get(format)) is None:
+        return data
+    try:
+        return stripper(data)
+    except (IndexError, ValueError):
+        return None
+
+
+def _strip_jpeg(data):
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG")
+    parts = [data[:2]]
+    pos = 2
+    while True:
+        if data[pos] != 0xFF:
+            raise ValueError("Expected a marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+        elif marker == 0xD9:  # End of image, drop trailing data
+            parts.append(data[pos : pos + 2])
+            return b"".join(parts)
+        elif marker == 0x00 or 0xD0 <= marker <= 0xD7:
+            raise ValueError("Unexpected marker")
+        else:
+            end = pos + 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+            segment = data[pos:end]
+            if len(segment) < 4 or end > len(data):
+                raise ValueError("Truncated segment")
+            # Keep JFIF (APP0), ICC profiles (APP2) and Adobe (APP14)
+            # segments which affect decoding, drop other application
+            # segments and comments
+            if not (0xE1 <= marker <= 0xEF and marker != 0xEE or marker == 0xFE) or (
+                marker == 0xE2 and segment[4:16] == b"ICC_PROFILE\x00"
+            ):
+                parts.append(segment)
+            pos = end
+            if marker == 0xDA:
+                # Entropy-coded data of a scan ends with the next marker which
+                # is neither a stuffed 0xFF byte nor a restart marker
+                if not (match := _JPEG_MARKER.search(data, pos)):
+                    raise ValueError("Missing end of image")
+                parts.append(data[pos : match.start()])
+                pos = match.start()
+
+
+def _strip_png(data):
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("Not a PNG")
+    parts = [data[:8]]
+    pos = 8
+    while True:
+        end = pos + 12 + int.from_bytes(data[pos : pos + 4], "big")
+        chunk_type = data[pos + 4 : pos + 8]
+        if end > len(data):
+            raise ValueError("Truncated chunk")
+        if chunk_type not in {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"tIME"}:
+            parts.append(data[pos:end])
+        if chunk_type == b"IEND":
+            return b"".join(parts)
+        pos = end
+
+
+_JPEG_MARKER = re.compile(rb"\xff[^\x00\xd0-\xd7]")
+_STRIPPERS = {"JPEG": _strip_jpeg, "PNG": _strip_png}
+
+
+def draft_scale(processors, size):
+    """
+    Return the factor by which the source image may be downscaled before
+    running the processors
+
+    Only processors which declared their behavior using ``@scales`` are
+    supported, and only if exactly one of them resizes the image.
+    """
+    found = []
+    for part in processors:
+        name, args = (
+            (part[0], part[1:]) if isinstance(part, list | tuple) else (part, ())
+        )
+        scale = getattr(PROCESSORS[name], "scale", None)
+        if scale is None:
+            return 1.0
+        if (factor := scale(size, *args)) is not None:
+            found.append(factor)
+    if len(found) != 1:
+        return 1.0
+    return min(1.0, found[0] * DRAFT_REDUCING_GAP)
+
+
+def draft(image, processors_list):
+    """
+    Configure the decoder to only produce the resolution needed by all specs
+
+    Only has an effect on JPEG images where the decoder is able to scale
+    images in the DCT domain, and has to be called before loading the image.
+    """
+    size = image.size
+    if image.getexif().get(ExifTags.Base.Orientation) in {5, 6, 7, 8}:
+        size = size[::-1]
+    scale = max(draft_scale(processors, size) for processors in processors_list)
+    if scale < 1:
+        image.draft(image.mode, tuple(math.ceil(c * scale) for c in image.size))
+
+
+DEFAULT_PROCESSORS = [
+    "preserve_icc_profile",
+    "process_gif",
+    "process_png",
+    "process_jpeg",
+    "autorotate",
+]
+
+
 @register
+@scales(keeps_scale)
+@passes_through(lambda image: is_passthrough(DEFAULT_PROCESSORS, image))
 def default(get_image):
-    return build_handler(
-        [
-            "preserve_icc_profile",
-            "process_gif",
-            "process_png",
-            "process_jpeg",
-            "autorotate",
-        ],
-        get_image,
-    )
+    return build_handler(DEFAULT_PROCESSORS, get_image)
 
 
 @register
+@scales(keeps_scale)
+def encoder(get_image, format, options):
+    """
+    Pass ``options`` to Pillow when saving images in ``format`` (or in all
+    formats if ``format`` is ``None``)
+
+    The options are applied when saving, after all processors have run, so
+    they take precedence over the options set by other processors no matter
+    where ``encoder`` appears in the spec. ``target_bytes`` searches for the
+    highest quality of lossy formats not exceeding the given size, but not
+    below ``min_quality``. Both are ignored when saving in other formats if
+    ``format`` is ``None`` and rejected otherwise.
+    """
+    if format is not None and format not in LOSSY_FORMATS:
+        if lossy := sorted({"target_bytes", "min_quality"} & set(options)):
+            raise ImproperlyConfigured(
+                f"Encoder options {lossy!r} are only supported by the lossy"
+                f" formats {sorted(LOSSY_FORMATS)!r}, not by {format!r}"
+            )
+    return get_image
+
+
+@register
+@scales(keeps_scale)
+@passes_through(lambda image: image.getexif().get(ExifTags.Base.Orientation, 1) == 1)
 def autorotate(get_image):
     def processor(image, context):
         return get_image(ImageOps.exif_transpose(image), context)
@@ -44,6 +377,8 @@ def autorotate(get_image):
 
 
 @register
+@scales(keeps_scale)
+@passes_through(lambda image: image.format != "JPEG" or image.mode == "RGB")
 def process_jpeg(get_image):
     def processor(image, context):
         if context.save_kwargs["format"] == "JPEG":
@@ -57,6 +392,8 @@ def process_jpeg(get_image):
 
 
 @register
+@scales(keeps_scale)
+@passes_through(lambda image: image.format != "PNG" or image.mode != "P")
 def process_png(get_image):
     def processor(image, context):
         if context.save_kwargs["format"] == "PNG" and image.mode == "P":
@@ -68,6 +405,8 @@ def process_png(get_image):
 
 
 @register
+@scales(keeps_scale)
+@passes_through(unchanged)
 def process_gif(get_image):
     def processor(image, context):
         if context.save_kwargs["format"] != "GIF":
@@ -84,6 +423,8 @@ def process_gif(get_image):
 
 
 @register
+@scales(keeps_scale)
+@passes_through(unchanged)
 def preserve_icc_profile(get_image):
     def processor(image, context):
         icc_profile = image.info.get("icc_profile")
@@ -95,18 +436,26 @@ def preserve_icc_profile(get_image):
 
 
 @register
+@scales(lambda size, bound: min(1.0, bound[0] / size[0], bound[1] / size[1]))
+@passes_through(
+    lambda image, bound: image.width <= bound[0] and image.height <= bound[1]
+)
 def thumbnail(get_image, size):
     def processor(image, context):
         image = get_image(image, context)
         f = min(1.0, size[0] / image.size[0], size[1] / image.size[1])
         return image.resize(
-            [int(f * coord) for coord in image.size], Image.Resampling.LANCZOS
+            [int(f * coord) for coord in image.size],
+            Image.Resampling.LANCZOS,
+            reducing_gap=RESIZE_REDUCING_GAP,
         )
 
     return processor
 
 
 @register
+@scales(lambda size, target: max(target[0] / size[0], target[1] / size[1]))
+@passes_through(lambda image, target: tuple(image.size) == tuple(target))
 def crop(get_image, size):
     width, height = size
 
@@ -152,17 +501,48 @@ def crop(get_image, size):
             elif crop_boundary_bottom > image.size[1]:
                 crop_boundary_bottom = image.size[1]
                 crop_boundary_top = image.size[1] - orig_crop_height
-        # Cropping the image from the original image
-        cropped_image = image.crop(
-            (
+        # Resizing the cropped part of the original image to the size
+        # specified (as determined by `width`x`height`)
+        return image.resize(
+            (width, height),
+            Image.Resampling.LANCZOS,
+            box=(
                 crop_boundary_left,
                 crop_boundary_top,
                 crop_boundary_right,
                 crop_boundary_bottom,
-            )
+            ),
+            reducing_gap=RESIZE_REDUCING_GAP,
         )
-        # Resizing the newly cropped image to the size specified
-        # (as determined by `width`x`height`)
-        return cropped_image.resize((width, height), Image.Resampling.LANCZOS)
 
     return processor
+
+
+@register
+@scales(lambda size, width: min(1.0, width / size[0]))
+@passes_through(lambda image, width: image.width <= width)
+def ladder(get_image, width):
+    def processor(image, context):
+        image = get_image(image, context)
+        if image.width <= width:
+            return image
+        return image.resize(
+            (width, max(1, round(image.height * width / image.width))),
+            Image.Resampling.LANCZOS,
+            reducing_gap=RESIZE_REDUCING_GAP,
+        )
+
+    return processor
+
+
+def ladder_formats(item, processors, widths):
+    """
+    Return formats for ``ImageField(formats=...)`` downscaling the result of
+    ``processors`` to each of ``widths``
+
+    The rungs are available as e.g. ``f"{item}_640"``, a ``srcset`` value
+    containing all of them as ``f"{item}_srcset"``. Rungs processed together
+    are downscaled from the next larger rung instead of the full-size image
+    if it is large enough.
+    """
+    return {f"{item}_{width}": [("ladder", width), *processors] for width in widths}
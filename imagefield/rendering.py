@@ -0,0 +1,93 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+
+from django.conf import settings
+
+
+class RenderExecutor:
+    """
+    Renders images in a bounded thread pool
+
+    Pillow releases the GIL while decoding, resizing and encoding images, so
+    threads allow using several cores without forking. ``memory_budget``
+    limits the estimated count of bytes of pixel data being rendered at the
+    same time; submitting more work blocks until enough renderings have
+    finished. A single rendering larger than the budget runs alone.
+    """
+
+    def __init__(self, max_workers, memory_budget):
+        self.max_workers = max_workers
+        self.memory_budget = memory_budget
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="imagefield-render"
+        )
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def _acquire(self, cost):
+        cost = min(cost, self.memory_budget)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._in_flight + cost <= self.memory_budget
+            )
+            self._in_flight += cost
+        return cost
+
+    def _release(self, cost):
+        with self._condition:
+            self._in_flight -= cost
+            self._condition.notify_all()
+
+    def map(self, fn, items, costs):
+        """
+        Return the results of calling ``fn`` with every item, in order
+
+        ``costs`` contains the estimated memory usage of every call.
+        """
+        futures = []
+        for item, cost in zip(items, costs):
+            acquired = self._acquire(cost)
+            future = self._executor.submit(fn, item)
+            future.add_done_callback(
+                lambda _f, acquired=acquired: self._release(acquired)
+            )
+            futures.append(future)
+        return [future.result() for future in futures]
+
+
+class SerialExecutor:
+    """
+    Renders images in the calling thread
+    """
+
+    def map(self, fn, items, costs):
+        return [fn(item) for item in items]
+
+
+def image_cost(image):
+    """
+    Estimate the memory used by rendering ``image`` (one byte per band and
+    pixel)
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+@cache
+def _render_executor(pid, max_workers, memory_budget):
+    # Thread pools do not survive forking; the process ID is part of the key
+    return RenderExecutor(max_workers, memory_budget)
+
+
+def render_executor(max_workers=None):
+    """
+    Return the executor used for rendering processed images
+
+    ``max_workers`` defaults to the ``IMAGEFIELD_RENDER_WORKERS`` setting.
+    """
+    if max_workers is None:
+        max_workers = settings.IMAGEFIELD_RENDER_WORKERS
+    if max_workers <= 1:
+        return SerialExecutor()
+    return _render_executor(os.getpid(), max_workers, settings.IMAGEFIELD_RENDER_MEMORY)
@@ -0,0 +1,34 @@
+from django import template
+
+from imagefield.picture import negotiate, picture_html
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def picture(fieldfile, item, **attrs):
+    """
+    Render a ``<picture>`` element offering all encodings of a format::
+
+        {% picture article.image "card" alt=article.title loading="lazy" %}
+    """
+    if not fieldfile:
+        return ""
+    return picture_html(fieldfile, item, **attrs)
+
+
+@register.simple_tag(takes_context=True)
+def negotiated_url(context, fieldfile, item):
+    """
+    Return the URL of the encoding of a format preferred by the client::
+
+        {% negotiated_url article.image "card" %}
+
+    Returns the URL of the fallback if the context contains no request.
+    """
+    if not fieldfile:
+        return ""
+    request = context.get("request")
+    accept = request.headers.get("Accept", "") if request else ""
+    return negotiate(fieldfile, item, accept)
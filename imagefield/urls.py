@@ -0,0 +1,10 @@
+from django.urls import re_path
+
+from imagefield import views
+
+
+urlpatterns = [
+    re_path(
+        r"^(?P<name>__processed__/.+)$", views.processed, name="imagefield_processed"
+    ),
+]
@@ -0,0 +1,178 @@
+import hashlib
+import mimetypes
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, Http404, HttpResponse
+from django.urls import NoReverseMatch, reverse
+
+from imagefield.fields import _exists, _imagefields_by_label
+from imagefield.models import ProcessedImage
+from imagefield.widgets import cache_timeout
+
+
+#: Seconds a rendering may take before other requests start rendering as well
+LOCK_TIMEOUT = 60
+#: Seconds a request waits for another request rendering the same image
+#: before responding with 503 Service Unavailable
+LOCK_WAIT = 5
+#: Seconds between checks whether another request finished rendering
+LOCK_POLL_INTERVAL = 0.1
+
+_PROCESSED_NAME = re.compile(
+    r"__processed__/(?P<bins>(?:[0-9a-f]{3}/)+)(?P<stem>[^/]+)-[0-9a-f]{12}(\.[^./]+)?"
+)
+#: Processed images of sources with a content digest are named after the
+#: SHA-1 digest
+_DIGEST = re.compile(r"[0-9a-f]{40}")
+
+
+def _key(prefix, name):
+    return f"imagefield-{prefix}:{hashlib.sha256(name.encode('utf-8')).hexdigest()}"
+
+
+def mounted():
+    """
+    Return whether the view is included in the URLconf
+    """
+    try:
+        reverse("imagefield_processed", kwargs={"name": "__processed__/x"})
+    except NoReverseMatch:
+        return False
+    return True
+
+
+def _names(fieldfile, formats=None):
+    """
+    Return a mapping of processed names of ``fieldfile`` to format names
+    """
+    formats = fieldfile.field.formats if formats is None else formats
+    return {
+        context.name: item
+        for item in formats
+        if (context := fieldfile._process_context(fieldfile.field.formats[item])).name
+    }
+
+
+def remember(fieldfiles, formats=None):
+    """
+    Record the source of processed images of ``fieldfiles`` using one cache
+    query so that the view finds them without querying the database
+
+    ``formats`` defaults to all formats of the fields.
+    """
+    entries = {}
+    for fieldfile in fieldfiles:
+        pk = None if fieldfile.instance._state.adding else fieldfile.instance.pk
+        for name, item in _names(fieldfile, formats).items():
+            entries[_key("resolve", name)] = (fieldfile.field.field_label, pk, item)
+    if entries:
+        cache.set_many(entries, timeout=cache_timeout())
+
+
+def _sources(field, digest, source=None):
+    """
+    Yield instances which may be the source of a processed name
+
+    Only uses indexable lookups: the manifest's source name or the content
+    digest. Nothing is queried if neither is known.
+    """
+    if field._fallback:
+        yield field.model()
+
+    if source:
+        queryset = field.model._base_manager.filter(**{field.name: source})
+    elif field.digest_field and digest:
+        queryset = field.model._base_manager.filter(
+            **{f"{field.digest_field}__startswith": f"{digest}:"}
+        )
+    else:
+        return
+    yield from queryset.iterator()
+
+
+def _resolve(name):
+    """
+    Return the image field file and the format a processed name belongs to
+
+    The source is looked up using the mapping recorded when URLs are
+    prefetched (see ``remember``), the manifest or the content digest. Other
+    processed names are unknown.
+    """
+    fields = _imagefields_by_label()
+    if resolved := cache.get(_key("resolve", name)):
+        label, pk, item = resolved
+        if field := fields.get(label):
+            manager = field.model._base_manager
+            instance = field.model() if pk is None else manager.filter(pk=pk).first()
+            if instance is not None:
+                fieldfile = getattr(instance, field.name)
+                if item in field.formats:
+                    context = fieldfile._process_context(field.formats[item])
+                    if context.name == name:
+                        return fieldfile, item
+
+    if not (match := _PROCESSED_NAME.fullmatch(name)):
+        raise Http404("Not a processed image")
+
+    source = None
+    if settings.IMAGEFIELD_MANIFEST:
+        # The manifest knows the source of processed images which have been
+        # generated before
+        source, _spec = ProcessedImage.objects.resolve(name) or (None, None)
+    # Only names of digest-based processed images are looked up by digest,
+    # those are also binned using the digest
+    digest = match["stem"]
+    if not (
+        _DIGEST.fullmatch(digest) and digest.startswith(match["bins"].replace("/", ""))
+    ):
+        digest = None
+
+    for field in fields.values():
+        for instance in _sources(field, digest, source):
+            fieldfile = getattr(instance, field.name)
+            if fieldfile.name or field._fallback:
+                names = _names(fieldfile)
+                if name in names:
+                    remember([fieldfile])
+                    return fieldfile, names[name]
+
+    raise Http404("Unknown processed image")
+
+
+def processed(request, name):
+    """
+    Serve processed images, rendering them first if necessary
+
+    Concurrent requests for the same processed image only render it once.
+    Requests waiting longer than ``LOCK_WAIT`` seconds for another request
+    rendering the image receive a 503 response.
+    """
+    fieldfile, item = _resolve(name)
+    storage = fieldfile.storage
+
+    deadline = time.monotonic() + LOCK_WAIT
+    while not _exists(storage, name):
+        if cache.add(_key("lock", name), 1, timeout=LOCK_TIMEOUT):
+            try:
+                if fieldfile.process(item) != name:  # Failed silently
+                    raise Http404("Processing failed")
+            finally:
+                cache.delete(_key("lock", name))
+            break
+        if time.monotonic() >= deadline:
+            return HttpResponse(
+                "The processed image is being rendered.",
+                content_type="text/plain",
+                status=503,
+                headers={"Retry-After": str(LOCK_WAIT)},
+            )
+        time.sleep(LOCK_POLL_INTERVAL)
+
+    content_type, _encoding = mimetypes.guess_type(name)
+    return FileResponse(
+        storage.open(name, "rb"),
+        content_type=content_type or "application/octet-stream",
+    )
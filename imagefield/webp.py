@@ -1,7 +1,8 @@
-from imagefield.processing import register
+from imagefield.processing import keeps_scale, register, scales
 
 
 @register
+@scales(keeps_scale)
 def force_webp(get_image):
     def processor(image, context):
         context.save_kwargs["format"] = "WEBP"
@@ -17,4 +18,5 @@ def webp(processors):
         context.extension = ".webp"
         context.processors = ["force_webp"] + processors
 
+    spec.cacheable = True
     return spec
@@ -1,7 +1,8 @@
-from imagefield.processing import register
+from imagefield.processing import keeps_scale, register, scales
 
 
 @register
+@scales(keeps_scale)
 def force_jpeg(get_image):
     def processor(image, context):
         context.save_kwargs["format"] = "JPEG"
@@ -24,4 +25,5 @@ def websafe(processors, extensions=None):
             context.processors = ["force_jpeg"]
             context.processors.extend(processors)
 
+    spec.cacheable = True
     return spec
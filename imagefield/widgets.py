@@ -3,7 +3,6 @@ import inspect
 
 from django import forms
 from django.conf import settings
-from django.core.cache import cache
 from django.core.files.uploadedfile import UploadedFile
 from django.forms.boundfield import BoundField
 from django.utils.html import format_html
@@ -57,16 +56,10 @@ class PreviewAndPPOIMixin:
 
         processors = self._unbind_processors()
         context = value._process_context(processors)
-        key = cache_key(context.name)
         url = value.storage.url(context.name)
-        if not cache.get(key):
-            try:
-                value.process(processors)
-                cache.set(key, 1, timeout=cache_timeout())
-            except Exception:
-                # Avoid crashing here since it will not be possible to even
-                # replace corrupted images otherwise.
-                pass
+        # Avoid crashing here since it will not be possible to even
+        # replace corrupted images otherwise.
+        value._process_or_defer(processors, silent=True)
 
         return format_html(
             '<div class="imagefield" data-ppoi-id="{ppoi}">'
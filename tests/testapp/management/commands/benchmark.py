@@ -0,0 +1,298 @@
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import timeit
+from functools import partial
+
+import django
+import PIL
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from PIL import Image
+
+import imagefield
+from imagefield.fields import Context, _context_lru, _safe_image_save, verified
+from imagefield.processing import _PIPELINES, build_handler
+from testapp.models import Model, WebsafeImage
+
+
+SIZES = {"small": (640, 480), "large": (3000, 2000)}
+FORMATS = {"JPEG": "RGB", "PNG": "RGBA", "GIF": "P"}
+PROCESSORS = {
+    "default": "default",
+    "autorotate": "autorotate",
+    "process_jpeg": "process_jpeg",
+    "process_png": "process_png",
+    "process_gif": "process_gif",
+    "preserve_icc_profile": "preserve_icc_profile",
+    "thumbnail": ("thumbnail", (300, 225)),
+    "crop": ("crop", (300, 300)),
+}
+
+
+def _image(size, format):
+    gradient = Image.radial_gradient("L").resize(SIZES[size])
+    image = Image.merge(
+        "RGB",
+        [
+            gradient,
+            gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+            gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM),
+        ],
+    )
+    image = (
+        image.quantize() if FORMATS[format] == "P" else image.convert(FORMATS[format])
+    )
+    with io.BytesIO() as buf:
+        image.save(buf, format=format)
+        return buf.getvalue()
+
+
+def bench_format_url(model, item):
+    """Accessing a format attribute which hasn't been accessed before"""
+    fieldfile = model(image="python-logo.jpg").image
+
+    def run():
+        fieldfile.__dict__.pop(item, None)
+        getattr(fieldfile, item)
+
+    return run
+
+
+def bench_format_url_uncached(model, item):
+    """Same as above, but without the memoization of processed names"""
+    run = bench_format_url(model, item)
+
+    def uncached():
+        _context_lru.clear()
+        run()
+
+    return uncached
+
+
+def bench_build_handler(*, cached):
+    processors = ["default", ("crop", (300, 300))]
+
+    def run():
+        if not cached:
+            _PIPELINES.clear()
+        build_handler(processors)
+
+    return run
+
+
+def bench_processor(processor, size, format):
+    """Running a processor on a decoded image"""
+    handler = build_handler([processor])
+    with Image.open(io.BytesIO(_image(size, format))) as image:
+        image.load()
+
+    def run():
+        context = Context(ppoi=(0.5, 0.5), save_kwargs={"format": format})
+        handler(image, context)
+
+    return run
+
+
+def bench_verified(level, size):
+    data = _image(size, "JPEG")
+
+    def run():
+        verified(Image.open(io.BytesIO(data)), level)
+
+    return run
+
+
+def bench_safe_image_save(size, format):
+    with Image.open(io.BytesIO(_image(size, format))) as image:
+        image.load()
+    kwargs = {"JPEG": {"quality": 90, "progressive": True}}.get(format, {})
+
+    def run():
+        with io.BytesIO() as buf:
+            _safe_image_save(image, buf, format=format, **kwargs)
+
+    return run
+
+
+def bench_clear_generated_files(files):
+    """Deleting the processed images of a source in a bin with many files"""
+    storage = FileSystemStorage(location=tempfile.mkdtemp())
+    fieldfile = Model(image="python-logo.jpg").image
+    fieldfile.storage = storage
+    base = fieldfile._process_base(fieldfile.name)
+    os.makedirs(storage.path(base.path))
+    for i in range(files):
+        open(storage.path(f"{base.path}/other-{i:012x}.jpg"), "wb").close()
+
+    def run():
+        for item in ["thumb", "desktop"]:
+            open(storage.path(f"{base.path}/{base.basename}{item}.jpg"), "wb").close()
+        fieldfile.field._clear_generated_files_for(fieldfile, None)
+
+    run.cleanup = lambda: shutil.rmtree(storage.location)
+    return run
+
+
+def bench_process_imagefields(objects):
+    """Running process_imagefields on a synthetic dataset, per object"""
+    media = tempfile.mkdtemp()
+    with open(os.path.join(media, "image.jpg"), "wb") as f:
+        f.write(_image("large", "JPEG"))
+
+    overrides = override_settings(MEDIA_ROOT=media)
+    overrides.enable()
+    name = connection.creation.create_test_db(verbosity=0)
+    Model.objects.bulk_create([Model(image="image.jpg") for i in range(objects)])
+
+    def run():
+        call_command(
+            "process_imagefields",
+            "testapp.model.image",
+            "--force",
+            "--no-parallel",
+            stdout=io.StringIO(),
+        )
+
+    def cleanup():
+        connection.creation.destroy_test_db(name, verbosity=0)
+        overrides.disable()
+        shutil.rmtree(media)
+
+    run.cleanup = cleanup
+    run.per_call = objects
+    return run
+
+
+#: Factories returning the function to benchmark and the default count of
+#: calls per timing run
+BENCHMARKS = {
+    "format_url": (partial(bench_format_url, Model, "thumb"), 1000),
+    "format_url_uncached": (partial(bench_format_url_uncached, Model, "thumb"), 1000),
+    "format_url_websafe": (partial(bench_format_url, WebsafeImage, "preview"), 1000),
+    "format_url_websafe_uncached": (
+        partial(bench_format_url_uncached, WebsafeImage, "preview"),
+        1000,
+    ),
+    "build_handler": (partial(bench_build_handler, cached=True), 1000),
+    "build_handler_uncached": (partial(bench_build_handler, cached=False), 1000),
+    **{
+        f"processor_{name}_{size}_{format.lower()}": (
+            partial(bench_processor, processor, size, format),
+            10 if size == "small" else 2,
+        )
+        for name, processor in PROCESSORS.items()
+        for size in SIZES
+        for format in FORMATS
+    },
+    **{
+        f"verified_{level}_{size}": (partial(bench_verified, level, size), 2)
+        for level in ["header", "decode", "paranoid"]
+        for size in SIZES
+    },
+    **{
+        f"safe_image_save_{size}_{format.lower()}": (
+            partial(bench_safe_image_save, size, format),
+            2,
+        )
+        for size in SIZES
+        for format in FORMATS
+    },
+    "clear_generated_files_10000": (partial(bench_clear_generated_files, 10000), 10),
+    "process_imagefields_20": (partial(bench_process_imagefields, 20), 1),
+}
+
+
+class Command(BaseCommand):
+    help = "Benchmark hot paths of django-imagefield and output JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "benchmark",
+            nargs="*",
+            help="Benchmarks to run, prefixes are allowed. Defaults to all.",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="Count of timing runs."
+        )
+        parser.add_argument(
+            "--number",
+            type=int,
+            default=None,
+            help="Calls per timing run. Defaults to a value per benchmark.",
+        )
+        parser.add_argument("--output", help="Also write the results to this file.")
+        parser.add_argument(
+            "--compare", help="Compare the results with an earlier output file."
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=1.2,
+            help="Fail if a benchmark is slower than this factor of --compare.",
+        )
+
+    def handle(self, **options):
+        results = []
+        for name, (factory, default_number) in BENCHMARKS.items():
+            if options["benchmark"] and not name.startswith(
+                tuple(options["benchmark"])
+            ):
+                continue
+            number = options["number"] or default_number
+            run = factory()
+            try:
+                timings = timeit.repeat(run, repeat=options["repeat"], number=number)
+            finally:
+                if cleanup := getattr(run, "cleanup", None):
+                    cleanup()
+            results.append(
+                {
+                    "name": name,
+                    "number": number,
+                    "best_us": min(timings)
+                    / number
+                    / getattr(run, "per_call", 1)
+                    * 1e6,
+                }
+            )
+
+        output = {
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "pillow": PIL.__version__,
+                "imagefield": imagefield.__version__,
+                "machine": platform.machine(),
+            },
+            "results": results,
+        }
+        self.stdout.write(json.dumps(output, indent=2))
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(output, f, indent=2)
+
+        if options["compare"]:
+            self._compare(results, options["compare"], options["threshold"])
+
+    def _compare(self, results, path, threshold):
+        with open(path) as f:
+            baseline = {
+                result["name"]: result["best_us"] for result in json.load(f)["results"]
+            }
+        regressions = [
+            "{}: {:.1f}us -> {:.1f}us".format(
+                result["name"], baseline[result["name"]], result["best_us"]
+            )
+            for result in results
+            if result["name"] in baseline
+            and result["best_us"] > baseline[result["name"]] * threshold
+        ]
+        if regressions:
+            raise CommandError("Regressions:\n" + "\n".join(regressions))
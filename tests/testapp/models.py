@@ -5,6 +5,8 @@ from django.db import models
 from django.utils.translation import gettext_lazy as _
 
 from imagefield.fields import ImageField, PPOIField
+from imagefield.picture import picture_formats
+from imagefield.prefetch import ImageFieldQuerySet
 from imagefield.websafe import websafe
 
 
@@ -35,7 +37,7 @@ class AbstractModel(models.Model):
 
 
 class Model(AbstractModel):
-    pass
+    objects = ImageFieldQuerySet.as_manager()
 
 
 class ProxyModel(Model):
@@ -103,3 +105,25 @@ class WebsafeImage(models.Model):
         fallback="python-logo.tiff",
         formats={"preview": websafe(["default", ("crop", (300, 300))])},
     )
+
+
+class DigestImage(models.Model):
+    image = ImageField(
+        _("image"),
+        upload_to="images",
+        auto_add_fields=True,
+        digest_field="image_digest",
+        formats={"thumb": ["default", ("crop", (20, 20))]},
+    )
+    image_digest = models.CharField(
+        max_length=50, blank=True, editable=False, db_index=True
+    )
+
+
+class PictureImage(models.Model):
+    image = ImageField(
+        _("image"),
+        upload_to="images",
+        auto_add_fields=True,
+        formats=picture_formats("card", ["default", ("crop", (20, 20))]),
+    )
@@ -0,0 +1,143 @@
+from unittest import mock
+
+from django.core.management import call_command
+from django.db.models.query import QuerySet
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from imagefield import backends
+from imagefield.backends import QueueBackend, generation_backend
+from imagefield.fields import ImageFieldFile
+from imagefield.models import GenerationTask
+from testapp.models import Model
+from testapp.utils import BaseTest, contents
+
+
+class BackendsTest(BaseTest):
+    @override_settings(
+        IMAGEFIELD_GENERATION_BACKEND="imagefield.backends.ThreadPoolBackend"
+    )
+    def test_thread_pool(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            Model.objects.create(image="python-logo.jpg")
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(contents("__processed__"), [])
+
+        for callback in callbacks:
+            callback()
+        generation_backend().wait()
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.jpg", "python-logo-e6a99ea713c8.jpg"],
+        )
+
+    @override_settings(IMAGEFIELD_GENERATION_BACKEND="imagefield.backends.QueueBackend")
+    def test_queue(self):
+        m = Model.objects.create(image="python-logo.jpg")
+        m.save()
+        self.assertEqual(contents("__processed__"), [])
+        self.assertEqual(
+            [str(task) for task in GenerationTask.objects.all()],
+            [f"testapp.model.image #{m.pk}"],
+        )
+
+        call_command("process_imagefield_queue", verbosity=0)
+        self.assertEqual(GenerationTask.objects.count(), 0)
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.jpg", "python-logo-e6a99ea713c8.jpg"],
+        )
+
+    @override_settings(IMAGEFIELD_GENERATION_BACKEND="imagefield.backends.QueueBackend")
+    def test_queue_deleted_object(self):
+        m = Model.objects.create(image="python-logo.jpg")
+        Model.objects.filter(pk=m.pk).delete()
+        call_command("process_imagefield_queue", verbosity=0)
+        self.assertEqual(GenerationTask.objects.count(), 0)
+        self.assertEqual(contents("__processed__"), [])
+
+    @override_settings(
+        IMAGEFIELD_GENERATION_BACKEND="imagefield.backends.ThreadPoolBackend"
+    )
+    def test_thread_pool_failure(self):
+        """Exceptions in the thread pool are logged"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            m = Model.objects.create(image="python-logo.jpg")
+
+        with (
+            mock.patch.object(
+                ImageFieldFile, "process_many", side_effect=ValueError("Boom")
+            ),
+            mock.patch.object(backends, "logger") as logger,
+        ):
+            for callback in callbacks:
+                callback()
+            generation_backend().wait()
+        self.assertEqual(logger.error.call_count, 1)
+        self.assertEqual(logger.error.call_args.args[1]["pk"], m.pk)
+
+    @override_settings(IMAGEFIELD_GENERATION_BACKEND="imagefield.backends.QueueBackend")
+    def test_queue_requeued_while_processing(self):
+        """Tasks queued again while being processed are kept"""
+        m = Model.objects.create(image="python-logo.jpg")
+        process_many = ImageFieldFile.process_many
+
+        def save_again(fieldfile, formats):
+            # Claimed tasks aren't processed by other workers
+            self.assertEqual(QueueBackend().drain(), 0)
+            Model.objects.get(pk=m.pk).save()
+            return process_many(fieldfile, formats)
+
+        with mock.patch.object(
+            ImageFieldFile, "process_many", autospec=True, side_effect=save_again
+        ):
+            self.assertEqual(QueueBackend().drain(), 1)
+        self.assertEqual(GenerationTask.objects.count(), 1)
+        self.assertIsNone(GenerationTask.objects.get().claimed_at)
+
+        call_command("process_imagefield_queue", verbosity=0)
+        self.assertEqual(GenerationTask.objects.count(), 0)
+
+    @override_settings(IMAGEFIELD_GENERATION_BACKEND="imagefield.backends.QueueBackend")
+    def test_queue_failure(self):
+        """Failed tasks are released and retried a limited number of times"""
+        Model.objects.create(image="python-logo.jpg")
+        backend = QueueBackend()
+
+        with (
+            mock.patch.object(
+                ImageFieldFile, "process_many", side_effect=ValueError("Boom")
+            ) as process_many,
+            mock.patch.object(backends, "logger"),
+        ):
+            for _i in range(backend.max_attempts + 1):
+                backend.drain()
+        self.assertEqual(process_many.call_count, backend.max_attempts)
+        task = GenerationTask.objects.get()
+        self.assertEqual(task.attempts, backend.max_attempts)
+        self.assertIsNone(task.claimed_at)
+
+        # Queueing the task again resets the attempts
+        Model.objects.get().save()
+        self.assertEqual(backend.drain(), 1)
+        self.assertEqual(GenerationTask.objects.count(), 0)
+
+    @override_settings(IMAGEFIELD_GENERATION_BACKEND="imagefield.backends.QueueBackend")
+    def test_queue_claimed_concurrently(self):
+        """Tasks claimed by another worker after selecting them are skipped"""
+        Model.objects.create(image="python-logo.jpg")
+        values_list = QuerySet.values_list
+
+        def claimed_elsewhere(queryset, *args, **kwargs):
+            result = list(values_list(queryset, *args, **kwargs))
+            if queryset.model is GenerationTask:
+                GenerationTask.objects.update(claimed_at=timezone.now())
+            return result
+
+        with (
+            mock.patch.object(QuerySet, "values_list", claimed_elsewhere),
+            mock.patch.object(ImageFieldFile, "process_many") as process_many,
+        ):
+            self.assertEqual(QueueBackend().drain(), 0)
+        self.assertEqual(process_many.call_count, 0)
+        self.assertEqual(GenerationTask.objects.count(), 1)
@@ -0,0 +1,230 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test.utils import override_settings
+
+from imagefield.models import ProcessedImage
+from testapp.models import Model
+from testapp.utils import BaseTest, contents
+
+
+class ProcessImagefieldsTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def call(self, *args):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command(
+            "process_imagefields", *args, "--no-parallel", stdout=stdout, stderr=stderr
+        )
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_process(self):
+        m1 = Model.objects.create(image="python-logo.jpg")
+        Model.objects.create(image="python-logo.png")
+        Model.objects.filter(pk=m1.pk).update(width=None, height=None)
+        self._rmtree()
+
+        stdout, stderr = self.call(
+            "testapp.model.image", "--chunk-size", "1", "--threads", "2"
+        )
+        self.assertIn("testapp.model.image - 2 objects - desktop, thumb", stdout)
+        self.assertIn("2/2", stdout)
+        self.assertEqual(stderr, "")
+        self.assertEqual(
+            contents("__processed__"),
+            [
+                "python-logo-24f8702383e7.jpg",
+                "python-logo-24f8702383e7.png",
+                "python-logo-e6a99ea713c8.jpg",
+                "python-logo-e6a99ea713c8.png",
+            ],
+        )
+
+        self.assertEqual(
+            list(Model.objects.filter(pk=m1.pk).values_list("width", "height")),
+            [(m1.width, m1.height)],
+        )
+
+    def test_housekeep(self):
+        m = Model.objects.create(image="python-logo.jpg", ppoi="0.2x0.2")
+        Model.objects.update(image="broken.png")
+
+        _stdout, stderr = self.call(
+            "testapp.model.image", "--housekeep", "blank-on-failure"
+        )
+        self.assertIn("Error while processing broken.png", stderr)
+        m.refresh_from_db()
+        self.assertEqual((m.image.name, m.ppoi, m.width), ("", "0.5x0.5", None))
+
+    def test_pk_range_and_resume(self):
+        pks = [Model.objects.create(image="python-logo.jpg").pk for _ in range(4)]
+        checkpoint = os.path.join(self.tmpdir, "checkpoint.json")
+
+        stdout, _stderr = self.call(
+            "testapp.model.image",
+            "--pk-range",
+            f"{pks[1]}:{pks[3]}",
+            "--checkpoint",
+            checkpoint,
+            "--chunk-size",
+            "1",
+        )
+        self.assertIn("2 objects", stdout)
+        with open(checkpoint) as f:
+            self.assertEqual(
+                json.load(f), {f"testapp.model.image:{pks[1]}:{pks[3]}": str(pks[1])}
+            )
+
+        stdout, _stderr = self.call(
+            "testapp.model.image",
+            "--pk-range",
+            f"{pks[1]}:{pks[3]}",
+            "--checkpoint",
+            checkpoint,
+            "--resume",
+        )
+        self.assertIn("0 objects", stdout)
+
+        # Other ranges are not affected
+        stdout, _stderr = self.call(
+            "testapp.model.image", "--checkpoint", checkpoint, "--resume"
+        )
+        self.assertIn("4 objects", stdout)
+
+        with self.assertRaisesRegex(CommandError, "Invalid --pk-range"):
+            self.call("testapp.model.image", "--pk-range", "a:b")
+        with self.assertRaisesRegex(CommandError, "--resume requires --checkpoint"):
+            self.call("testapp.model.image", "--resume")
+
+    @override_settings(IMAGEFIELD_MANIFEST=True)
+    def test_incremental(self):
+        m1 = Model.objects.create(image="python-logo.jpg")
+        Model.objects.create(image="python-logo.png")
+        self.assertEqual(ProcessedImage.objects.count(), 4)
+        self.assertEqual(
+            ProcessedImage.objects.existing(
+                ["__processed__/d00/python-logo-24f8702383e7.jpg", "unknown.jpg"]
+            ),
+            {"__processed__/d00/python-logo-24f8702383e7.jpg"},
+        )
+
+        formats = {
+            "testapp.model.image": {
+                "thumb": ["default", ("crop", (300, 300))],
+                "desktop": ["default", ("thumbnail", (300, 225))],
+                "small": ["default", ("thumbnail", (20, 20))],
+            }
+        }
+        with (
+            override_settings(IMAGEFIELD_FORMATS=formats),
+            mock.patch.object(
+                m1.image.storage, "exists", wraps=m1.image.storage.exists
+            ) as exists,
+        ):
+            self.call("testapp.model.image", "--incremental")
+        # Only the new format has been checked (and saved, which calls exists
+        # as well)
+        small = {
+            Model.objects.get(pk=pk)
+            .image._process_context(formats["testapp.model.image"]["small"])
+            .name
+            for pk in Model.objects.values_list("pk", flat=True)
+        }
+        self.assertEqual({call.args[0] for call in exists.call_args_list}, small)
+        self.assertEqual(ProcessedImage.objects.count(), 6)
+        self.assertEqual(len(contents("__processed__")), 6)
+
+        # Deleting processed images also removes them from the manifest
+        m1.image.field._clear_generated_files(m1)
+        self.assertEqual(ProcessedImage.objects.count(), 3)
+
+    def test_incremental_without_manifest(self):
+        with self.assertRaisesRegex(CommandError, "requires IMAGEFIELD_MANIFEST"):
+            self.call("testapp.model.image", "--incremental")
+
+
+class CleanImagefieldsTest(BaseTest):
+    def call(self, *args):
+        stdout = io.StringIO()
+        call_command("clean_imagefields", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_clean(self):
+        Model.objects.create(image="python-logo.jpg")
+        m2 = Model.objects.create(image="python-logo.png")
+        Model.objects.filter(pk=m2.pk).update(image="python-logo.gif")
+        processed = [
+            "python-logo-24f8702383e7.jpg",
+            "python-logo-24f8702383e7.png",
+            "python-logo-e6a99ea713c8.jpg",
+            "python-logo-e6a99ea713c8.png",
+        ]
+        self.assertEqual(contents("__processed__"), processed)
+
+        formats = {"testapp.model.image": {"thumb": ["default", ("crop", (300, 300))]}}
+        with override_settings(IMAGEFIELD_FORMATS=formats):
+            self.assertIn(
+                "Found 2 orphaned processed images.",
+                self.call("--dry-run", "--verbosity", "2"),
+            )
+            self.assertEqual(contents("__processed__"), processed)
+
+            self.assertIn(
+                "Deleted 2 orphaned processed images.",
+                self.call("--batch-size", "1", "--rate", "1000"),
+            )
+            self.assertEqual(contents("__processed__"), processed[::2])
+
+            # Processed images of removed formats of existing sources
+            self.assertIn(
+                "Deleted 1 orphaned processed images.",
+                self.call("--unused-formats"),
+            )
+            self.assertEqual(
+                contents("__processed__"), ["python-logo-24f8702383e7.jpg"]
+            )
+
+        self.assertIn("Deleted 0 orphaned processed images.", self.call())
+
+    def test_clean_renditions(self):
+        """Renditions of the proxy and the preview are kept by default"""
+        m = Model.objects.create(image="python-logo.jpg")
+        self._rmtree()
+        str(m.image.thumbnail["20x20"])
+        preview = m.image.process(m.image.field._preview_spec())
+        self.assertEqual(len(contents("__processed__")), 2)
+
+        self.assertIn("Deleted 0 orphaned processed images.", self.call())
+        self.assertIn(
+            "Deleted 1 orphaned processed images.", self.call("--unused-formats")
+        )
+        self.assertEqual(contents("__processed__"), [preview.rpartition("/")[2]])
+
+    @override_settings(IMAGEFIELD_MANIFEST=True)
+    def test_clean_manifest(self):
+        m = Model.objects.create(image="python-logo.jpg")
+        self.assertEqual(ProcessedImage.objects.count(), 2)
+        Model.objects.filter(pk=m.pk).delete()  # Doesn't call _clear_generated_files
+        Model.objects.create(image="python-logo.png")
+
+        with mock.patch(
+            "imagefield.management.commands.clean_imagefields._walk"
+        ) as walk:
+            self.assertIn("Deleted 2 orphaned processed images.", self.call())
+        self.assertEqual(walk.call_count, 0)
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.png", "python-logo-e6a99ea713c8.png"],
+        )
+        self.assertEqual(ProcessedImage.objects.count(), 2)
@@ -1,22 +1,56 @@
+import hashlib
 import io
 import os
 import pickle
 import re
 import sys
+import threading
 import time
-from unittest import expectedFailure, skipIf
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import expectedFailure, mock, skipIf
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import ContentFile
 from django.db import models
 from django.test import Client
 from django.test.utils import isolate_apps, override_settings
 from django.urls import reverse
-from PIL import Image
-
-from imagefield.fields import IMAGEFIELDS, Context, ImageField, _SealableAttribute
+from PIL import ExifTags, Image, ImageChops, ImageFile, ImageStat
+
+from imagefield.fields import (
+    IMAGEFIELDS,
+    Context,
+    ImageField,
+    ImageFieldFile,
+    _exists_lru,
+    _safe_image_save,
+    _SealableAttribute,
+    batched_processing,
+    hashdigest,
+    verified,
+)
+from imagefield.middleware import batched_processing_middleware
+from imagefield.models import ProcessedImage
+from imagefield.prefetch import prefetch_formats
+from imagefield.processing import (
+    PROCESSORS,
+    Pipeline,
+    build_handler,
+    compiled,
+    draft,
+    is_passthrough,
+    ladder_formats,
+    register,
+    spec_key,
+    strip_metadata,
+)
+from imagefield.rendering import RenderExecutor, SerialExecutor, render_executor
 from testapp.models import (
+    DigestImage,
     Model,
     ModelWithOptional,
     NullableImage,
@@ -257,6 +291,29 @@ class Test(BaseTest):
         with override_settings(IMAGEFIELD_SILENTFAILURE=True):
             self.assertEqual(m.image.process("desktop"), "broken.png")
 
+    def test_silent_failure_per_spec(self):
+        """Failing specs fall back to the source without affecting other specs"""
+
+        @register
+        def explode(get_image):
+            def processor(image, context):
+                raise ValueError("Boom")
+
+            return processor
+
+        m = Model(image="python-logo.jpg")
+        try:
+            with override_settings(IMAGEFIELD_SILENTFAILURE=True):
+                names = m.image.process_many([["default", "explode"], "thumb", []])
+        finally:
+            del PROCESSORS["explode"]
+        self.assertEqual(names[0], "python-logo.jpg")
+        self.assertEqual(names[1], "__processed__/d00/python-logo-24f8702383e7.jpg")
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.jpg", os.path.basename(names[2])],
+        )
+
     def test_cmyk_validation(self):
         """
         Test that the image verification can handle CMYK images.
@@ -333,6 +390,8 @@ class Test(BaseTest):
                 "testapp.modelwithoptional.image",
                 "testapp.nullableimage.image",
                 "testapp.websafeimage.image",
+                "testapp.digestimage.image",
+                "testapp.pictureimage.image",
             },
         )
 
@@ -504,3 +563,736 @@ class Test(BaseTest):
 
         m.image.delete()
         self.assertEqual(contents("__processed__"), [])
+
+    def test_process_many(self):
+        """Processing several formats opens and decodes the source only once"""
+        m = Model(image="python-logo.jpg")
+        with mock.patch.object(Image, "open", wraps=Image.open) as image_open:
+            names = m.image.process_many(
+                ["thumb", "desktop", [("thumbnail", (20, 20))]]
+            )
+
+        self.assertEqual(image_open.call_count, 1)
+        self.assertEqual(
+            names,
+            [
+                "__processed__/d00/python-logo-24f8702383e7.jpg",
+                "__processed__/d00/python-logo-e6a99ea713c8.jpg",
+                "__processed__/d00/python-logo-43feb031c1be.jpg",
+            ],
+        )
+        self.assertEqual(
+            contents("__processed__"),
+            [
+                "python-logo-24f8702383e7.jpg",
+                "python-logo-43feb031c1be.jpg",
+                "python-logo-e6a99ea713c8.jpg",
+            ],
+        )
+        path = os.path.join(settings.MEDIA_ROOT, names[0])
+        with Image.open(path) as image:
+            self.assertEqual(image.size, (300, 300))
+
+        # Nothing left to do
+        with mock.patch.object(Image, "open", wraps=Image.open) as image_open:
+            self.assertEqual(m.image.process_many(["thumb", "desktop"]), names[:2])
+        self.assertEqual(image_open.call_count, 0)
+
+    def test_render_executor(self):
+        """Formats may be rendered in threads within a memory budget"""
+        m = Model(image="python-logo.jpg")
+        specs = ["thumb", "desktop", [("thumbnail", (20, 20))]]
+
+        def render(executor):
+            contexts = [
+                m.image._process_context(m.image._spec_processors(spec)[0])
+                for spec in specs
+            ]
+            return m.image._process_many(contexts, executor=executor)
+
+        self.assertEqual(render(RenderExecutor(3, 2**30)), render(SerialExecutor()))
+
+        running = []
+        maximum = []
+        lock = threading.Lock()
+
+        def fn(item):
+            with lock:
+                running.append(item)
+                maximum.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(item)
+            return item * 2
+
+        executor = RenderExecutor(3, memory_budget=100)
+        self.assertEqual(executor.map(fn, range(6), [60] * 6), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(max(maximum), 1)
+        self.assertEqual(executor.map(fn, range(6), [1000] * 6), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(max(maximum), 1)
+
+        self.assertIsInstance(render_executor(), SerialExecutor)
+        with override_settings(IMAGEFIELD_RENDER_WORKERS=4):
+            self.assertIsInstance(render_executor(), RenderExecutor)
+            self.assertIs(render_executor(), render_executor())
+            self.assertIsInstance(render_executor(1), SerialExecutor)
+
+    def test_draft(self):
+        """Large JPEGs are decoded at the lowest resolution still sufficient"""
+        with io.BytesIO() as buf:
+            Image.radial_gradient("L").resize((2400, 1600)).convert("RGB").save(
+                buf, format="JPEG"
+            )
+            m = Model(ppoi="0.2x0.7")
+            m.image.save("large.jpg", ContentFile(buf.getvalue()), save=False)
+
+        with Image.open(m.image.path) as image:
+            draft(image, [["default", ("crop", (300, 300))]])
+            self.assertEqual(image.size, (1200, 800))
+        with Image.open(m.image.path) as image:
+            draft(image, [["default", ("crop", (300, 300))], ["default"]])
+            self.assertEqual(image.size, (2400, 1600))
+        with Image.open(m.image.path) as image:
+            draft(image, [["default", ("thumbnail", (200, 200))]])
+            self.assertEqual(image.size, (600, 400))
+
+        processors = ["default", ("crop", (300, 300))]
+        with Image.open(io.BytesIO(m.image._process(processors=processors))) as a:
+            with mock.patch("imagefield.fields.draft"):
+                full = m.image._process(processors=processors)
+            with Image.open(io.BytesIO(full)) as b:
+                self.assertEqual(a.size, b.size)
+                diff = ImageChops.difference(a.convert("L"), b.convert("L"))
+                self.assertLess(ImageStat.Stat(diff).mean[0], 2)
+
+    def test_exists_cache(self):
+        """Saving again does not hit the storage when processed images exist"""
+        m = Model.objects.create(image="python-logo.jpg")
+        with mock.patch.object(m.image.storage, "exists") as exists:
+            m.save()
+        self.assertEqual(exists.call_count, 0)
+
+        # The Django cache is used if the image isn't in the local cache
+        _exists_lru.clear()
+        with mock.patch.object(m.image.storage, "exists") as exists:
+            m.save()
+        self.assertEqual(exists.call_count, 0)
+
+        m._meta.get_field("image")._clear_generated_files(m)
+        self.assertEqual(contents("__processed__"), [])
+        m.save()
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.jpg", "python-logo-e6a99ea713c8.jpg"],
+        )
+
+        with override_settings(IMAGEFIELD_EXISTS_CACHE=False):
+            with mock.patch.object(m.image.storage, "exists") as exists:
+                m.save()
+            self.assertEqual(exists.call_count, 2)
+
+        # Entries of the local cache expire after a few seconds
+        name = m.image.process("thumb")
+        self.assertEqual(_exists_lru.get(name), 1)
+        later = time.monotonic() + 6
+        with mock.patch("imagefield.fields.time.monotonic", return_value=later):
+            self.assertIsNone(_exists_lru.get(name))
+
+    @override_settings(IMAGEFIELD_EXISTS_CACHE=False)
+    def test_exists_cache_disabled(self):
+        """The proxy and the widget use the Django cache in any case"""
+        m = Model(image="python-logo.jpg")
+        str(m.image.thumbnail["20x20"])
+        with mock.patch.object(m.image.storage, "exists") as exists:
+            str(m.image.thumbnail["20x20"])
+            with batched_processing():
+                str(m.image.thumbnail["20x20"])
+        self.assertEqual(exists.call_count, 0)
+        self.assertIsNone(_exists_lru.get(m.image.process("thumb")))
+
+    async def test_aprocess(self):
+        """Images are processed and resolved from async code"""
+        m = Model(image="python-logo.jpg")
+        with mock.patch.object(
+            m.image.storage, "exists", wraps=m.image.storage.exists
+        ) as exists:
+            names = await m.image.aprocess_many(["thumb", "desktop"])
+        self.assertEqual(
+            names,
+            [
+                "__processed__/d00/python-logo-24f8702383e7.jpg",
+                "__processed__/d00/python-logo-e6a99ea713c8.jpg",
+            ],
+        )
+        self.assertEqual({call.args[0] for call in exists.call_args_list}, set(names))
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.jpg", "python-logo-e6a99ea713c8.jpg"],
+        )
+
+        # Existing images are found using the cache
+        _exists_lru.clear()
+        with mock.patch.object(m.image.storage, "exists") as exists:
+            self.assertEqual(await m.image.aprocess("thumb"), names[0])
+        self.assertEqual(exists.call_count, 0)
+
+        self.assertEqual(
+            await m.image.aurl("thumb"),
+            "/media/__processed__/d00/python-logo-24f8702383e7.jpg",
+        )
+        with override_settings(IMAGEFIELD_VERSATILEIMAGEPROXY=True):
+            self.assertEqual(
+                await m.image.thumbnail["20x20"].aurl(),
+                "/media/__processed__/d00/python-logo-f26eb6811b04.jpg",
+            )
+        self.assertEqual(await NullableImage().image.aurl("thumb"), "")
+
+    @override_settings(IMAGEFIELD_VERSATILEIMAGEPROXY=True)
+    def test_batched_processing(self):
+        """Cache lookups of a batch of images are combined"""
+        images = [
+            Model(image="python-logo.jpg"),
+            Model(image="python-logo.png"),
+            Model(image="python-logo.tiff"),
+        ]
+
+        def render():
+            middleware = batched_processing_middleware(
+                lambda request: [str(m.image.thumbnail["20x20"]) for m in images]
+            )
+            # Internal calls of the cache backend are not recorded
+            with mock.patch("imagefield.fields.cache", wraps=cache) as mocked:
+                urls = middleware(None)
+            calls = [mocked.get, mocked.set, mocked.get_many, mocked.set_many]
+            return urls, tuple(call.call_count for call in calls)
+
+        self.assertEqual(contents("__processed__"), [])
+        urls, calls = render()
+        self.assertEqual(
+            urls,
+            [
+                "/media/__processed__/d00/python-logo-f26eb6811b04.jpg",
+                "/media/__processed__/beb/python-logo-f26eb6811b04.png",
+                "/media/__processed__/639/python-logo-f26eb6811b04.tiff",
+            ],
+        )
+        self.assertEqual(calls, (0, 0, 1, 1))
+        self.assertEqual(
+            contents("__processed__"),
+            [
+                "python-logo-f26eb6811b04.jpg",
+                "python-logo-f26eb6811b04.png",
+                "python-logo-f26eb6811b04.tiff",
+            ],
+        )
+
+        _exists_lru.clear()
+        with mock.patch.object(images[0].image.storage, "exists") as exists:
+            self.assertEqual(render(), (urls, (0, 0, 1, 0)))
+        self.assertEqual(exists.call_count, 0)
+
+        # Nested blocks and failures
+        images.append(Model(image="broken.png"))
+        with self.assertRaises(OSError), batched_processing():
+            with batched_processing():
+                str(images[-1].image.thumbnail["20x20"])
+            self.assertEqual(len(contents("__processed__")), 3)
+
+    def test_prefetch_formats(self):
+        """URLs and the existence of processed images are looked up in bulk"""
+        Model.objects.create(image="python-logo.jpg")
+        Model.objects.create(image="python-logo.png")
+        self._rmtree()
+
+        queryset = Model.objects.order_by("pk").prefetch_formats("image")
+        self.assertEqual(prefetch_formats([], "image"), set())
+
+        m1, m2 = queryset
+        with mock.patch.object(ImageFieldFile, "_process_context") as pc:
+            self.assertEqual(
+                [m1.image.thumb, m2.image.desktop],
+                [
+                    "/media/__processed__/d00/python-logo-24f8702383e7.jpg",
+                    "/media/__processed__/beb/python-logo-e6a99ea713c8.png",
+                ],
+            )
+        self.assertEqual(pc.call_count, 0)
+
+        with mock.patch("imagefield.prefetch.cache", wraps=cache) as mocked:
+            missing = prefetch_formats(
+                [m1, m2], "image", ["thumb"], generate=True, list_bins=True
+            )
+        self.assertEqual(
+            missing,
+            {
+                "__processed__/d00/python-logo-24f8702383e7.jpg",
+                "__processed__/beb/python-logo-24f8702383e7.png",
+            },
+        )
+        self.assertEqual(mocked.get_many.call_count, 1)
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.jpg", "python-logo-24f8702383e7.png"],
+        )
+
+        # Processed images which exist are found by listing their folders
+        cache.clear()
+        _exists_lru.clear()
+        storage = m1.image.storage
+        with (
+            mock.patch.object(storage, "exists") as exists,
+            mock.patch.object(storage, "listdir", wraps=storage.listdir) as listdir,
+        ):
+            self.assertEqual(
+                list(
+                    Model.objects.order_by("pk").prefetch_formats(
+                        "image", check=True, list_bins=True
+                    )
+                ),
+                [m1, m2],
+            )
+        self.assertEqual(exists.call_count, 0)
+        self.assertEqual(listdir.call_count, 2)
+
+        # Only images missing from the cache are looked up in the storage
+        with mock.patch.object(storage, "exists", return_value=False) as exists:
+            self.assertEqual(
+                prefetch_formats([m1, m2], "image", check=True),
+                {
+                    "__processed__/d00/python-logo-e6a99ea713c8.jpg",
+                    "__processed__/beb/python-logo-e6a99ea713c8.png",
+                },
+            )
+        self.assertEqual(exists.call_count, 2)
+
+    @override_settings(IMAGEFIELD_MANIFEST=True)
+    def test_manifest_lookups(self):
+        """The manifest maps processed images to their sources and specs"""
+        m = Model.objects.create(image="python-logo.jpg")
+        context = m.image._process_context(m.image.field.formats["thumb"])
+        self.assertEqual(
+            ProcessedImage.objects.resolve(context.name),
+            ("python-logo.jpg", context.spec_hash),
+        )
+        self.assertIsNone(ProcessedImage.objects.resolve("unknown.jpg"))
+        self.assertEqual(
+            sorted(ProcessedImage.objects.names_for_source("python-logo.jpg")),
+            [
+                "__processed__/d00/python-logo-24f8702383e7.jpg",
+                "__processed__/d00/python-logo-e6a99ea713c8.jpg",
+            ],
+        )
+        self.assertEqual(
+            ProcessedImage.objects.names_for_spec(context.spec_hash), [context.name]
+        )
+
+        # Only processed images recorded in the manifest are deleted, the
+        # storage isn't listed
+        with override_settings(IMAGEFIELD_MANIFEST=False):
+            unrecorded = m.image.process(["default", ("crop", (10, 10))])
+        self.assertEqual(len(contents("__processed__")), 3)
+        self.assertEqual(ProcessedImage.objects.count(), 2)
+        with mock.patch.object(m.image.storage, "listdir") as listdir:
+            m._meta.get_field("image")._clear_generated_files(m)
+        self.assertEqual(listdir.call_count, 0)
+        self.assertEqual(contents("__processed__"), [os.path.basename(unrecorded)])
+        self.assertEqual(ProcessedImage.objects.count(), 0)
+        self._rmtree()
+
+        # Processed images shared by sources with equal contents are found
+        # using the digest in their names
+        with openimage("python-logo.jpg") as f:
+            content = f.read()
+        first, second = DigestImage(), DigestImage()
+        first.image.save("first.jpg", ContentFile(content))
+        second.image.save("second.jpg", ContentFile(content))
+        first.image.delete()
+        self.assertEqual(len(contents("__processed__")), 1)
+        second.image.delete()
+        self.assertEqual(contents("__processed__"), [])
+        self.assertEqual(ProcessedImage.objects.count(), 0)
+
+    def test_compiled_pipelines(self):
+        """Equal specs share their compiled pipelines"""
+        spec = ["default", ("crop", (20, 20))]
+        pipeline = compiled(spec)
+        self.assertIs(compiled(["default", ("crop", (20, 20))]), pipeline)
+        self.assertIs(build_handler(spec), pipeline)
+        self.assertEqual(pipeline.spec, "default|('crop', (20, 20))")
+        self.assertIsNot(compiled(["default", ["crop", [20, 20]]]), pipeline)
+
+        # Lists and tuples result in different names
+        m = Model(image="python-logo.jpg")
+        self.assertNotEqual(
+            m.image._process_context(spec).name,
+            m.image._process_context(["default", ["crop", (20, 20)]]).name,
+        )
+
+        @register
+        def noop(get_image, options=None):
+            return get_image
+
+        try:
+            # Unhashable specs are compiled every time
+            spec = ["default", ("noop", {"a", "b"})]
+            self.assertIsNot(compiled(spec), compiled(spec))
+
+            # Registering processors invalidates compiled pipelines
+            pipeline = compiled(["noop"])
+            register(noop)
+            self.assertIsNot(compiled(["noop"]), pipeline)
+        finally:
+            del PROCESSORS["noop"]
+
+    def test_digest_field(self):
+        """Sources with equal contents share processed images"""
+        with openimage("python-logo.jpg") as f:
+            content = f.read()
+
+        m1 = DigestImage()
+        m1.image.save("first.jpg", ContentFile(content))
+        digest = hashlib.sha1(content).hexdigest()
+        self.assertEqual(m1.image_digest, f"{digest}:{hashdigest(m1.image.name)[:8]}")
+        self.assertEqual(
+            m1.image.thumb,
+            f"/media/__processed__/{digest[:3]}/{digest}-10c070f1761f.jpeg",
+        )
+        self.assertEqual(len(contents("__processed__")), 1)
+
+        m2 = DigestImage()
+        with mock.patch.object(ImageFieldFile, "_process_many") as process_many:
+            m2.image.save("second.jpg", ContentFile(content))
+        self.assertEqual(process_many.call_count, 0)
+        self.assertEqual(m2.image.thumb, m1.image.thumb)
+        self.assertEqual(len(contents("__processed__")), 1)
+
+        # Processed images are only deleted with the last source
+        m1.image.delete()
+        self.assertEqual(m1.image_digest, "")
+        self.assertEqual(len(contents("__processed__")), 1)
+        m2.image.delete()
+        self.assertEqual(contents("__processed__"), [])
+
+        # The on-demand view finds sources using their digest
+        m3 = DigestImage()
+        m3.image.save("third.jpg", ContentFile(content))
+        m3.image.field._clear_generated_files(m3)
+        self.assertEqual(contents("__processed__"), [])
+        self.assertEqual(self.client.get(m3.image.thumb).status_code, 200)
+        self.assertEqual(len(contents("__processed__")), 1)
+
+        # Names changed without saving the file fall back to name-based names
+        m3.image = "python-logo.jpg"
+        self.assertEqual(m3.image._digest(), "")
+        self.assertTrue(
+            m3.image.thumb.startswith("/media/__processed__/d00/python-logo-")
+        )
+
+    def test_ladder(self):
+        """Ladder rungs are downscaled from larger rungs"""
+        formats = ladder_formats("hero", ["default"], [40, 80, 160, 1000])
+        with override_settings(IMAGEFIELD_FORMATS={"testapp.model.image": formats}):
+            resize = Image.Image.resize
+            with mock.patch.object(
+                Image.Image, "resize", autospec=True, side_effect=resize
+            ) as patched:
+                m = Model.objects.create(image="python-logo.jpg")
+            self.assertEqual(
+                [(call.args[0].width, call.args[1]) for call in patched.call_args_list],
+                [(300, (160, 160)), (160, (80, 80)), (80, (40, 40))],
+            )
+
+            # Rungs wider than the source are rendered at the source's width
+            srcset = (
+                f"{m.image.hero_40} 40w, {m.image.hero_80} 80w,"
+                f" {m.image.hero_160} 160w, {m.image.hero_1000} 300w"
+            )
+            self.assertEqual(m.image.hero_srcset, srcset)
+            m = Model.objects.get()
+            m.width = None
+            self.assertEqual(m.image.hero_srcset, srcset)
+            with self.assertRaises(AttributeError):
+                _read = m.image.thumb_srcset
+
+            # Rungs rendered alone have the same size
+            path = os.path.join(
+                settings.MEDIA_ROOT, m.image.process("hero_80", force=True)
+            )
+            with Image.open(path) as image:
+                self.assertEqual(image.size, (80, 80))
+
+    def test_encoder(self):
+        """Encoder options of the spec take precedence when saving"""
+        m = Model(image="python-logo.jpg")
+
+        def size(name):
+            return os.path.getsize(os.path.join(settings.MEDIA_ROOT, name))
+
+        processors = ["default", ("crop", (200, 200))]
+        default, low, other = m.image.process_many(
+            [
+                processors,
+                [("encoder", "JPEG", {"quality": 30}), *processors],
+                [*processors, ("encoder", "PNG", {"compress_level": 1})],
+            ]
+        )
+        self.assertLess(size(low), size(default))
+        self.assertEqual(size(other), size(default))
+        # Specs with encoder options are memoized as well
+        self.assertEqual(
+            spec_key([("encoder", "JPEG", {"quality": 30, "optimize": True})]),
+            spec_key([("encoder", "JPEG", {"optimize": True, "quality": 30})]),
+        )
+        # Keys of different types can be ordered, the order doesn't matter
+        self.assertEqual(
+            spec_key([("encoder", "JPEG", {1: "a", "quality": 30})]),
+            spec_key([("encoder", "JPEG", {"quality": 30, 1: "a"})]),
+        )
+        self.assertEqual(
+            compiled([("encoder", "JPEG", {"quality": 30, "optimize": True})]).spec,
+            Pipeline([("encoder", "JPEG", {"optimize": True, "quality": 30})]).spec,
+        )
+        # Options for finding sizes are only supported by lossy formats
+        with self.assertRaises(ImproperlyConfigured):
+            m.image.process([*processors, ("encoder", "PNG", {"target_bytes": 100})])
+        # Equal values of different types result in different names
+        self.assertEqual(
+            len(
+                {
+                    spec_key([("encoder", "JPEG", {"optimize": value})])
+                    for value in [1, 1.0, True]
+                }
+            ),
+            3,
+        )
+
+        resize = Image.Image.resize
+        with mock.patch.object(
+            Image.Image, "resize", autospec=True, side_effect=resize
+        ) as patched:
+            target = m.image.process(
+                [*processors, ("encoder", None, {"target_bytes": 6000})]
+            )
+        # The processed image is only re-encoded
+        self.assertEqual(patched.call_count, 1)
+        self.assertLessEqual(size(target), 6000)
+        self.assertGreater(size(target), 4000)
+
+        # Too small targets use the minimum quality
+        tiny, minimum = m.image.process_many(
+            [
+                [*processors, ("encoder", None, {"target_bytes": 1, "min_quality": 5})],
+                [*processors, ("encoder", None, {"quality": 5})],
+            ]
+        )
+        self.assertEqual(size(tiny), size(minimum))
+
+    def test_passthrough(self):
+        """Sources already satisfying the spec are copied as-is"""
+        m = Model(image="python-logo.jpg")
+        with openimage("python-logo.jpg") as f:
+            source = f.read()
+
+        def read(name):
+            with open(os.path.join(settings.MEDIA_ROOT, name), "rb") as f:
+                return f.read()
+
+        with mock.patch.object(ImageFile.ImageFile, "load") as load:
+            names = m.image.process_many(
+                [
+                    ["default", ("thumbnail", (400, 400))],
+                    ["default", ("crop", (300, 300))],
+                ]
+            )
+        self.assertEqual(load.call_count, 0)
+        # Only the XMP metadata of the source has been removed
+        stripped = strip_metadata(source, "JPEG")
+        self.assertLess(len(stripped), len(source))
+        self.assertEqual([read(name) for name in names], [stripped, stripped])
+        with (
+            Image.open(io.BytesIO(source)) as image,
+            Image.open(io.BytesIO(stripped)) as copy,
+        ):
+            self.assertNotIn("xmp", copy.info)
+            self.assertEqual(copy.tobytes(), image.tobytes())
+
+        for processors in [
+            ["default", ("thumbnail", (200, 400))],
+            ["default", ("crop", (300, 200))],
+            ["default", ("encoder", "JPEG", {"quality": 50})],
+        ]:
+            with self.subTest(processors=processors):
+                self.assertNotEqual(read(m.image.process(processors)), source)
+
+        with override_settings(IMAGEFIELD_PASSTHROUGH=False):
+            name = m.image.process(["default", ("crop", (300, 300))], force=True)
+            self.assertNotEqual(read(name), source)
+
+        for image in ["cmyk.jpg", "exif-orientation-examples/Landscape_6.jpg"]:
+            with self.subTest(image=image), openimage(image) as f:
+                self.assertFalse(is_passthrough(["default"], Image.open(f)))
+
+        # Sources whose format doesn't match the extension are processed
+        with openimage("python-logo.png") as f:
+            self.assertFalse(is_passthrough(["default"], Image.open(f), ".jpg"))
+
+    def test_passthrough_metadata(self):
+        """Copied sources do not leak EXIF metadata such as GPS positions"""
+        exif = Image.Exif()
+        exif[ExifTags.Base.Make] = "SecretCam"
+        exif.get_ifd(ExifTags.IFD.GPSInfo)[ExifTags.GPS.GPSLatitude] = (1.0, 2.0, 3.0)
+        with io.BytesIO() as buf:
+            Image.new("RGB", (100, 100), "red").save(
+                buf, format="JPEG", exif=exif, comment=b"Secret"
+            )
+            content = buf.getvalue()
+
+        m = Model()
+        m.image.save("secret.jpg", ContentFile(content), save=False)
+        for spec in [["default", ("thumbnail", (200, 200))], ["default"]]:
+            with self.subTest(spec=spec):
+                name = m.image.process(spec)
+                with Image.open(os.path.join(settings.MEDIA_ROOT, name)) as image:
+                    self.assertEqual(dict(image.getexif()), {})
+                    self.assertNotIn("comment", image.info)
+
+        # Metadata which cannot be removed prevents passing sources through
+        with io.BytesIO() as buf:
+            Image.new("RGB", (100, 100), "red").save(buf, format="WEBP", exif=exif)
+            self.assertFalse(is_passthrough(["default"], Image.open(buf)))
+
+    def test_process_context_memo(self):
+        """Processed names are memoized for lists and cacheable callable specs"""
+        calls = []
+
+        def spec(fieldfile, context):
+            calls.append(context.extension)
+            context.processors = [("thumbnail", (20, 20))]
+
+        m1 = Model(image="python-logo.jpg")
+        m2 = Model(image="python-logo.jpg")
+        self.assertEqual(
+            m1.image._process_context(spec).name,
+            m2.image._process_context(spec).name,
+        )
+        self.assertEqual(calls, [".jpg", ".jpg"])
+
+        spec.cacheable = True
+        calls.clear()
+        for m in (m1, m2):
+            context = m.image._process_context(spec)
+            self.assertEqual(
+                context.name, "__processed__/d00/python-logo-43feb031c1be.jpg"
+            )
+            self.assertEqual(context.processors, [("thumbnail", (20, 20))])
+        self.assertEqual(calls, [".jpg"])
+
+        # The PPOI is part of the key
+        m2.ppoi = "0.3x0.3"
+        self.assertNotEqual(
+            m1.image._process_context(["default", ("crop", (20, 20))]).name,
+            m2.image._process_context(["default", ("crop", (20, 20))]).name,
+        )
+
+    def test_image_property_memory(self):
+        """Validating images does not copy the whole file into memory"""
+        with io.BytesIO() as buf:
+            Image.effect_noise((1000, 1000), 64).convert("RGB").save(buf, format="PNG")
+            size = buf.tell()
+            m = Model()
+            m.image.save("noise.png", ContentFile(buf.getvalue()), save=False)
+
+        m = Model(image=m.image.name)
+        m.image.close()
+        tracemalloc.start()
+        try:
+            self.assertEqual(m.image._image.size, (1000, 1000))
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, size / 4)
+
+    def test_validation_levels(self):
+        """Validation levels range from checking the header to encoding images"""
+        with openimage("python-logo.jpg") as f:
+            truncated = f.read()[:-1000]
+
+        for level, error in [
+            ("header", None),
+            ("decode", "image file is truncated"),
+            ("paranoid", "image file is truncated"),
+        ]:
+            with override_settings(IMAGEFIELD_VALIDATION=level):
+                image = Image.open(io.BytesIO(truncated))
+                if error:
+                    with self.assertRaisesRegex(OSError, error):
+                        verified(image)
+                else:
+                    self.assertIs(verified(image), image)
+
+        with openimage("python-logo.jpg") as f:
+            with mock.patch("imagefield.fields._safe_image_save") as safe_image_save:
+                # JPEGs are decoded at a reduced scale
+                image = Image.open(f)
+                size = image.size
+                self.assertLess(verified(image, "decode").size, size)
+                self.assertEqual(safe_image_save.call_count, 0)
+                verified(Image.open(f), "paranoid")
+                self.assertEqual(safe_image_save.call_count, 3)
+
+            with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 100):
+                with self.assertRaises(Image.DecompressionBombError):
+                    verified(Image.open(f), "header")
+
+            with self.assertRaises(ImproperlyConfigured):
+                verified(Image.open(f), "unknown")
+
+    def test_safe_image_save(self):
+        """Saving progressive JPEGs works concurrently in all modes"""
+        maxblock = ImageFile.MAXBLOCK
+        images = [
+            Image.frombytes(mode, (400, 400), os.urandom(400 * 400 * len(mode)))
+            for mode in ["RGB", "CMYK", "L"]
+        ]
+
+        def save(image):
+            with io.BytesIO() as buf:
+                _safe_image_save(
+                    image, buf, format="JPEG", quality=100, progressive=True
+                )
+                with Image.open(io.BytesIO(buf.getvalue())) as saved:
+                    return saved.size, saved.info.get("progressive")
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            self.assertEqual(
+                list(executor.map(save, images * 3)), [((400, 400), 1)] * 9
+            )
+        # Process-global state is left alone
+        self.assertEqual(ImageFile.MAXBLOCK, maxblock)
+
+        # I/O errors are not swallowed
+        class FullDisk(io.BytesIO):
+            def write(self, data):
+                raise OSError("No space left on device")
+
+        with self.assertRaisesRegex(OSError, "No space left"):
+            _safe_image_save(images[0], FullDisk(), format="JPEG", progressive=True)
+
+    def test_safe_image_save_without_subsampling(self):
+        """Noisy 4:4:4 JPEGs exceeding Pillow's buffer estimate are saved"""
+        for size in [400, 1000]:
+            image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+            for quality in [90, 94]:
+                with self.subTest(size=size, quality=quality), io.BytesIO() as buf:
+                    _safe_image_save(
+                        image,
+                        buf,
+                        format="JPEG",
+                        quality=quality,
+                        progressive=True,
+                        subsampling=0,
+                    )
+                    with Image.open(io.BytesIO(buf.getvalue())) as saved:
+                        saved.load()
+                        self.assertEqual(saved.size, (size, size))
+                        self.assertTrue(saved.info.get("progressive"))
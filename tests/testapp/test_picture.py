@@ -0,0 +1,110 @@
+import os
+from unittest import mock
+
+from django.conf import settings
+from django.template import Context, Template
+from django.test import RequestFactory
+from PIL import Image
+
+from imagefield.picture import encoded, negotiate
+from testapp.models import Model, PictureImage
+from testapp.utils import BaseTest, contents
+
+
+#: AVIF support depends on the version and the build of Pillow
+AVIF = "AVIF" in Image.SAVE
+
+
+class PictureTest(BaseTest):
+    def test_encodings(self):
+        """All encodings of a format are rendered from one resized image"""
+        resize = Image.Image.resize
+        with mock.patch.object(
+            Image.Image, "resize", autospec=True, side_effect=resize
+        ) as patched:
+            m = PictureImage.objects.create(image="python-logo.jpg")
+        self.assertEqual(patched.call_count, 1)
+        self.assertEqual(
+            contents("__processed__"),
+            [
+                *(["python-logo-3ed0c4d603ce.avif"] if AVIF else []),
+                "python-logo-7043b955a3f6.jpg",
+                "python-logo-b042b04097c3.webp",
+            ],
+        )
+
+        for item, format, mode in [
+            ("card", "JPEG", "RGB"),
+            ("card_webp", "WEBP", "RGB"),
+            *([("card_avif", "AVIF", "RGB")] if AVIF else []),
+        ]:
+            path = os.path.join(
+                settings.MEDIA_ROOT, getattr(m.image, item).removeprefix("/media/")
+            )
+            with Image.open(path) as image:
+                self.assertEqual(image.format, format)
+                self.assertEqual(image.mode, mode)
+                self.assertEqual(image.size, (20, 20))
+
+    def test_fallback(self):
+        """Sources in other formats than PNG and GIF fall back to JPEG"""
+        m = Model(image="python-logo.tiff")
+        processors = ["default", ("crop", (20, 20))]
+        names = m.image.process_many([encoded(processors), encoded(processors, "WEBP")])
+        self.assertEqual(
+            [os.path.splitext(name)[1] for name in names], [".jpg", ".webp"]
+        )
+        with Image.open(os.path.join(settings.MEDIA_ROOT, names[0])) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.mode, "RGB")
+
+    def test_picture_tag(self):
+        m = PictureImage(image="python-logo.png")
+        html = Template(
+            '{% load imagefield %}{% picture m.image "card" alt="Python" %}'
+        ).render(Context({"m": m}))
+        avif = (
+            f'<source type="image/avif" srcset="{m.image.card_avif}">' if AVIF else ""
+        )
+        self.assertHTMLEqual(
+            html,
+            f"""
+            <picture>
+              {avif}
+              <source type="image/webp" srcset="{m.image.card_webp}">
+              <img src="{m.image.card}" alt="Python">
+            </picture>
+            """,
+        )
+
+        self.assertEqual(
+            Template('{% load imagefield %}{% picture m.image "card" %}').render(
+                Context({"m": PictureImage()})
+            ),
+            "",
+        )
+
+    def test_negotiate(self):
+        m = PictureImage(image="python-logo.png")
+        for accept, url in [
+            (
+                "image/avif,image/webp,image/apng,*/*;q=0.8",
+                m.image.card_avif if AVIF else m.image.card_webp,
+            ),
+            ("image/webp,*/*", m.image.card_webp),
+            ("image/avif;q=0, image/webp", m.image.card_webp),
+            ("*/*", m.image.card),
+            ("", m.image.card),
+        ]:
+            with self.subTest(accept=accept):
+                self.assertEqual(negotiate(m.image, "card", accept), url)
+
+    def test_negotiated_url_tag(self):
+        """The fallback is used if the context contains no request"""
+        m = PictureImage(image="python-logo.png")
+        template = Template('{% load imagefield %}{% negotiated_url m.image "card" %}')
+        self.assertEqual(template.render(Context({"m": m})), m.image.card)
+        request = RequestFactory().get("/", HTTP_ACCEPT="image/webp")
+        self.assertEqual(
+            template.render(Context({"m": m, "request": request})), m.image.card_webp
+        )
@@ -0,0 +1,156 @@
+import io
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test.utils import override_settings
+from PIL import Image
+
+from imagefield import views
+from imagefield.fields import ImageFieldFile
+from imagefield.prefetch import prefetch_formats
+from testapp.models import DigestImage, Model, WebsafeImage
+from testapp.utils import BaseTest, contents, openimage
+
+
+@override_settings(IMAGEFIELD_AUTOGENERATE=False)
+class ProcessedViewTest(BaseTest):
+    def test_processed(self):
+        m = Model.objects.create(image="python-logo.jpg")
+        self._rmtree()
+
+        # Prefetching records the sources of all processed images at once
+        with mock.patch.object(cache, "set_many", wraps=cache.set_many) as set_many:
+            prefetch_formats([m, Model.objects.get()], "image", ["thumb", "desktop"])
+        self.assertEqual(set_many.call_count, 1)
+        self.assertEqual(len(set_many.call_args.args[0]), 2)
+
+        response = self.client.get(m.image.thumb)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        with Image.open(io.BytesIO(b"".join(response.streaming_content))) as image:
+            self.assertEqual(image.size, (300, 300))
+        self.assertEqual(contents("__processed__"), ["python-logo-24f8702383e7.jpg"])
+
+        # The reverse lookup of all formats of the source is cached
+        with mock.patch.object(views, "_sources") as sources:
+            response = self.client.get(m.image.thumb)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(m.image.desktop)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(sources.call_count, 0)
+        self.assertEqual(
+            contents("__processed__"),
+            ["python-logo-24f8702383e7.jpg", "python-logo-e6a99ea713c8.jpg"],
+        )
+
+    def test_fallback(self):
+        response = self.client.get(WebsafeImage().image.preview)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(contents("__processed__"), ["python-logo-2ebc6e32bcdb.jpg"])
+
+    def test_unknown(self):
+        Model.objects.create(image="python-logo.jpg")
+        cache.clear()
+        for url in [
+            "/media/__processed__/d00/python-logo-000000000000.jpg",
+            "/media/__processed__/abc/python-logo-24f8702383e7.jpg",
+            "/media/__processed__/python-logo.jpg",
+        ]:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+        # Names which have not been prefetched are unknown, the database is
+        # only queried using lookups of content digests
+        m = Model.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(m.image.thumb).status_code, 404)
+            self.assertEqual(
+                self.client.get(
+                    f"/media/__processed__/abc/{'0' * 40}-000000000000.jpg"
+                ).status_code,
+                404,
+            )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.client.get(
+                    f"/media/__processed__/000/{'0' * 40}-000000000000.jpg"
+                ).status_code,
+                404,
+            )
+        prefetch_formats([m], "image")
+        self.assertEqual(self.client.get(m.image.thumb).status_code, 200)
+
+    def test_unmounted(self):
+        """Sources are only recorded if the view is in the URLconf"""
+        m = Model.objects.create(image="python-logo.jpg")
+        with (
+            mock.patch.object(views, "reverse", side_effect=views.NoReverseMatch),
+            mock.patch.object(cache, "set_many") as set_many,
+        ):
+            prefetch_formats([m], "image")
+            m.image.thumb  # noqa: B018
+        self.assertEqual(set_many.call_count, 0)
+
+    def test_digest(self):
+        """Processed images named after the content digest are found"""
+        m = DigestImage()
+        with openimage("python-logo.jpg") as f:
+            m.image.save("digest.jpg", ContentFile(f.read()))
+        name = m.image._process_context(m.image.field.formats["thumb"]).name
+        self.assertIn(m.image._digest(), name)
+        m.image.field._clear_generated_files(m)
+        cache.clear()
+
+        response = self.client.get(f"/media/{name}")
+        self.assertEqual(response.status_code, 200)
+
+    def test_single_flight(self):
+        """Requests wait while another request renders the same image"""
+        m = Model.objects.create(image="python-logo.jpg")
+        self._rmtree()
+        prefetch_formats([m], "image")
+        name = m.image._process_context(m.image.field.formats["thumb"]).name
+        cache.add(views._key("lock", name), 1)
+
+        def sleep(seconds):
+            # Another request finishes rendering
+            m.image.process("thumb")
+
+        with (
+            mock.patch.object(views.time, "sleep", side_effect=sleep),
+            mock.patch.object(
+                ImageFieldFile,
+                "_process_many",
+                autospec=True,
+                side_effect=ImageFieldFile._process_many,
+            ) as process_many,
+        ):
+            response = self.client.get(m.image.thumb)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(process_many.call_count, 1)
+
+    def test_lock_wait(self):
+        """Requests do not wait for other requests rendering for long"""
+        m = Model.objects.create(image="python-logo.jpg")
+        self._rmtree()
+        prefetch_formats([m], "image")
+        name = m.image._process_context(m.image.field.formats["thumb"]).name
+        cache.add(views._key("lock", name), 1)
+
+        with mock.patch.object(views, "LOCK_WAIT", 0):
+            response = self.client.get(m.image.thumb)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "0")
+        self.assertEqual(contents("__processed__"), [])
+
+    @override_settings(IMAGEFIELD_AUTOGENERATE=True, IMAGEFIELD_MANIFEST=True)
+    def test_manifest(self):
+        """Sources recorded in the manifest are looked up directly"""
+        m = Model.objects.create(image="python-logo.jpg")
+        self._rmtree()
+
+        with mock.patch.object(views, "_sources", wraps=views._sources) as sources:
+            response = self.client.get(m.image.thumb)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sources.call_args_list[0].args[2], "python-logo.jpg")
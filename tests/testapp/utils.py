@@ -4,9 +4,12 @@ import os
 import shutil
 
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils.translation import deactivate_all
 
+from imagefield.fields import _exists_lru
+
 
 def openimage(path):
     return open(os.path.join(settings.MEDIA_ROOT, path), "rb")
@@ -31,6 +34,8 @@ class BaseTest(TestCase):
         logging.disable(logging.NOTSET)
 
     def _rmtree(self):
+        cache.clear()
+        _exists_lru.clear()
         shutil.rmtree(
             os.path.join(settings.MEDIA_ROOT, "__processed__"), ignore_errors=True
         )